@@ -6,6 +6,6 @@ from sys import version_info
 if version_info >= (3, 9):
   List = list
   Tuple = tuple
-  from beartype.typing import Optional
+  from beartype.typing import Optional, Union
 else:
-  from typing import List, Tuple, Optional
+  from typing import List, Tuple, Optional, Union
@@ -6,10 +6,13 @@ import getpass
 
 from lib.check_helper import quickxorhash
 from lib.shell_helper import OneDriveShell, LsFormatter, MsFolderFormatter, MsFileFormatter
-from lib.msobject_info import ObjectInfoFactory
+from lib.msobject_info import DictMsObject, ObjectInfoFactory
 from lib.bulk_helper import bulk_folder_download, bulk_folder_upload
 from beartype import beartype
+from lib._typing import Optional
+from lib.cache_helper import HashCache
 from lib.graph_helper import MsGraphClient
+from lib.index_helper import DriveIndex
 import os
 
 lg = logging.getLogger('odc.action')
@@ -44,12 +47,16 @@ def action_upload(
         mgc: MsGraphClient,
         remote_folder: str,
         src_file: str,
-        with_progress_bar: bool):
+        with_progress_bar: bool,
+        chunk_reader: str = "readahead",
+        chunk_size: Optional[int] = None):
   # Upload a file
   mgc.put_file_content(
       remote_folder,
       src_file,
-      with_progress_bar=with_progress_bar
+      with_progress_bar=with_progress_bar,
+      chunk_reader=chunk_reader,
+      chunk_size=chunk_size
   )
 
 
@@ -57,10 +64,16 @@ def action_upload(
 def action_mupload(
         mgc: MsGraphClient,
         src_local_path: str,
-        dst_remote_folder: str):
+        dst_remote_folder: str,
+        nb_jobs: int = 1,
+        hash_cache: Optional[HashCache] = None,
+        compare_mode: str = "hash"):
   lg.debug(
-      f"action_mupload - folder = '{src_local_path}' to '{dst_remote_folder}'")
-  bulk_folder_upload(mgc, src_local_path, dst_remote_folder)
+      f"action_mupload - folder = '{src_local_path}' to '{dst_remote_folder}'"
+      f" - jobs = {nb_jobs} - compare = {compare_mode}")
+  bulk_folder_upload(
+      mgc, src_local_path, dst_remote_folder,
+      nb_jobs=nb_jobs, hash_cache=hash_cache, compare_mode=compare_mode)
 
 
 @beartype
@@ -76,10 +89,15 @@ def action_raw_cmd(mgc: MsGraphClient):
 
 
 @beartype
-def action_download(mgc: MsGraphClient, remote_file: str, dst_local_path: str):
+def action_download(
+        mgc: MsGraphClient,
+        remote_file: str,
+        dst_local_path: str,
+        nb_connections: int = 1):
   r = mgc.download_file_content(
       remote_file,
-      dst_local_path
+      dst_local_path,
+      nb_connections=nb_connections
   )
 
 
@@ -88,10 +106,16 @@ def action_mdownload(
         mgc: MsGraphClient,
         folder_path: str,
         dest_path: str,
-        max_depth: int):
+        max_depth: int,
+        nb_jobs: int = 1,
+        hash_cache: Optional[HashCache] = None,
+        compare_mode: str = "hash"):
   lg.debug(
-      f"action_mdownload - folder = '{folder_path}' - depth = '{max_depth}'")
-  bulk_folder_download(mgc, folder_path, dest_path, max_depth)
+      f"action_mdownload - folder = '{folder_path}' - depth = '{max_depth}'"
+      f" - jobs = {nb_jobs} - compare = {compare_mode}")
+  bulk_folder_download(
+      mgc, folder_path, dest_path, max_depth, nb_jobs, hash_cache,
+      compare_mode)
 
 
 @beartype
@@ -132,8 +156,12 @@ def action_share(mgc: MsGraphClient, path: str):
 
 
 @beartype
-def action_shell(mgc: MsGraphClient):
-  od_shell = OneDriveShell(mgc)
+def action_shell(
+        mgc: MsGraphClient,
+        root_cache_filename: Optional[str] = None,
+        max_objects: int = 0):
+  DictMsObject.set_max_objects(max_objects if max_objects > 0 else None)
+  od_shell = OneDriveShell(mgc, root_cache_filename)
   od_shell.launch()
 
 
@@ -149,6 +177,20 @@ def action_mkdir(mgc: MsGraphClient, remote_folder: str):
 
 
 @beartype
-def action_qxh(src_file: str):
-  qxh = quickxorhash()
-  print(qxh.quickxorhash(src_file))
+def action_qxh(
+        src_file: str,
+        backend: Optional[str] = None,
+        with_benchmark: bool = False):
+  if with_benchmark:
+    quickxorhash.benchmark(src_file)
+  else:
+    qxh = quickxorhash(backend)
+    print(qxh.quickxorhash(src_file))
+
+
+@beartype
+def action_index(drive_index: DriveIndex, reset: bool = False):
+  if drive_index.refresh(full=reset):
+    print(f"{drive_index.nb_items():,} items in index {drive_index.filename}")
+  else:
+    print("error during refresh of index")
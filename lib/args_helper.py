@@ -6,6 +6,7 @@
 import argparse
 import sys
 from lib._common import get_versionned_name
+from lib.chunk_helper import CHUNK_READERS
 
 
 def parse_odc_args(default_action):
@@ -47,6 +48,16 @@ def parse_odc_args(default_action):
       help='add a progress bar',
       action="store_true",
       default=False)
+  parser_upload.add_argument(
+      '--reader',
+      choices=CHUNK_READERS.keys(),
+      help='how chunks of large file are read (default = readahead)',
+      default="readahead")
+  parser_upload.add_argument(
+      '--chunk-size',
+      type=int,
+      help='fixed size in MiB of chunks of large file (default = adaptive)',
+      default=None)
   parser_upload.add_argument('srcfile', type=str, help='source file')
   parser_upload.add_argument('dstpath', type=str, help='destination path')
   parser_upload.set_defaults(command="put")
@@ -61,6 +72,18 @@ def parse_odc_args(default_action):
       'dstremotefolder',
       type=str,
       help='destination remote folder')
+  parser_mupload.add_argument(
+      '--jobs',
+      '-j',
+      type=int,
+      help='number of files uploaded simultaneously (default = 1)',
+      default=1)
+  parser_mupload.add_argument(
+      '--compare',
+      choices=("hash", "size-mtime"),
+      help='how local and remote files are compared. size-mtime compares'
+      ' hashes only if modification times differ (default = hash)',
+      default="hash")
   parser_mupload.set_defaults(command="mput")
 
   parser_get_user = sub_parsers.add_parser('whoami', help='get user')
@@ -79,6 +102,12 @@ def parse_odc_args(default_action):
 
   parser_browse = sub_parsers.add_parser(
       'shell', help='interaction shell')
+  parser_browse.add_argument(
+      '--max-objects',
+      type=int,
+      help='number of remote objects kept in memory before forgetting'
+      ' least recently used folders (default = 1000000, 0 = no limit)',
+      default=1000000)
   parser_browse.set_defaults(command="shell")
 
   parser_download = sub_parsers.add_parser(
@@ -88,6 +117,12 @@ def parse_odc_args(default_action):
       'dstlocalpath',
       type=str,
       help='destination path where file will be downloaded')
+  parser_download.add_argument(
+      '--connections',
+      '-c',
+      type=int,
+      help='number of simultaneous connections for a large file (default = 1)',
+      default=1)
   parser_download.set_defaults(command="get")
 
   parser_mdownload = sub_parsers.add_parser(
@@ -106,6 +141,18 @@ def parse_odc_args(default_action):
       type=int,
       help='maximum depth',
       default=999)
+  parser_mdownload.add_argument(
+      '--jobs',
+      '-j',
+      type=int,
+      help='number of files downloaded simultaneously (default = 1)',
+      default=1)
+  parser_mdownload.add_argument(
+      '--compare',
+      choices=("hash", "size-mtime"),
+      help='how local and remote files are compared. size-mtime compares'
+      ' hashes only if modification times differ (default = hash)',
+      default="hash")
   parser_mdownload.set_defaults(command="mget")
 
   parser_get_info = sub_parsers.add_parser(
@@ -143,12 +190,31 @@ def parse_odc_args(default_action):
 
   parser_quickxorhash = sub_parsers.add_parser(
       'qxh', help='compute quickxorhash of file')
+  parser_quickxorhash.add_argument(
+      '--backend',
+      choices=("numpy", "python", "external"),
+      help='how hash is computed (default = numpy if available)',
+      default=None)
+  parser_quickxorhash.add_argument(
+      '--benchmark',
+      help='compare duration of computation of available backends',
+      action="store_true",
+      default=False)
   parser_quickxorhash.add_argument('srcfile', type=str, help='source file')
   parser_quickxorhash.set_defaults(command="qxh")
 
   parser_raw_cmd = sub_parsers.add_parser('raw_cmd', help="raw command")
   parser_raw_cmd.set_defaults(command="raw_cmd")
 
+  parser_index = sub_parsers.add_parser(
+      'index', help='build or refresh the local index of the drive')
+  parser_index.add_argument(
+      '--reset',
+      help='rebuild the index from scratch',
+      action="store_true",
+      default=False)
+  parser_index.set_defaults(command="index")
+
   parser_version = sub_parsers.add_parser(
       'version', help="print version number")
   parser_version.set_defaults(command="version")
@@ -4,25 +4,93 @@
 import logging
 
 import os
-from lib.check_helper import quickxorhash
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from lib.check_helper import HashingStage, quickxorhash
 from beartype import beartype
+from lib._typing import Optional
+from lib.cache_helper import HashCache
+from lib.delta_helper import DeltaEnumerator, DeltaError
 from lib.graph_helper import MsGraphClient
+from lib.manifest_helper import RemoteManifest
 from lib.msobject_info import (
     ObjectInfoFactory, MsFolderInfo, MsFileInfo)
 
 lg = logging.getLogger('odc.bulk')
 qxh = quickxorhash()
 
+# How local and remote files are compared
+#   hash        files of same size are compared with their quickXorHash
+#   size-mtime  files of same size and same modification time are considered
+#               as identical. Hashes are compared only if times differ
+COMPARE_MODES = ("hash", "size-mtime")
+MTIME_TOLERANCE = 2  # seconds. OneDrive stores times with a 1s precision
+
+
+class TransferPool:
+  """ Bounded pool of workers used to transfer files.
+
+      With only one worker, transfers are run in the calling thread.
+      An error is logged for each failed transfer without stopping the others.
+  """
+
+  def __init__(self, nb_workers=1):
+    self.nb_workers = nb_workers
+    if nb_workers > 1:
+      self.__executor = ThreadPoolExecutor(max_workers=nb_workers)
+      # Limit number of pending transfers so that the producer does not
+      # walk the whole tree before first transfers are done
+      self.__slots = BoundedSemaphore(nb_workers * 4)
+    else:
+      self.__executor = None
+      self.__slots = None
+    self.__lock = Lock()
+    self.failures = []
+
+  def submit(self, description, fn, *args, **kwargs):
+    if self.__executor is None:
+      self.__run(description, fn, *args, **kwargs)
+    else:
+      self.__slots.acquire()
+      future = self.__executor.submit(
+          self.__run, description, fn, *args, **kwargs)
+      future.add_done_callback(lambda f: self.__slots.release())
+
+  def __run(self, description, fn, *args, **kwargs):
+    try:
+      fn(*args, **kwargs)
+    except Exception as e:
+      self.report_failure(description, e)
+
+  def report_failure(self, description, error):
+    lg.error(f"[TransferPool]{description} - failed - {error}")
+    with self.__lock:
+      self.failures.append((description, error))
+
+  def wait(self):
+    """ Wait for the end of all transfers.
+        Return True if no transfer has failed
+    """
+    if self.__executor is not None:
+      self.__executor.shutdown(wait=True)
+    if len(self.failures) > 0:
+      lg.error(f"[TransferPool]{len(self.failures)} transfer(s) failed")
+    return len(self.failures) == 0
+
 
 @beartype
 def bulk_folder_download(
         mgc: MsGraphClient,
         folder_path: str,
         dest_path: str,
-        max_depth: int):
+        max_depth: int,
+        nb_jobs: int = 1,
+        hash_cache: Optional[HashCache] = None,
+        compare_mode: str = "hash"):
   lg.debug(
       f"bulk_folder_download - folder = '{folder_path}'"
-      f" - dest_path = {dest_path} - depth = '{max_depth}'")
+      f" - dest_path = {dest_path} - depth = '{max_depth}' - jobs = {nb_jobs}"
+      f" - compare = {compare_mode}")
   remote_object = ObjectInfoFactory.get_object_info(
       mgc, folder_path, no_warn_if_no_parent=True)
 
@@ -36,8 +104,187 @@ def bulk_folder_download(
         f"[bulk_folder_download]'{dest_path}' is a file")
     return False
 
-  folder_info.retrieve_children_info(recursive=True, depth=max_depth)
-  mdownload_folder(mgc, folder_info, dest_path, depth=max_depth)
+  hasher = HashingStage(cache=hash_cache)
+  pool = TransferPool(nb_jobs)
+  # Delta enumerates the whole tree whatever the depth: a few levels are
+  # cheaper to list folder by folder
+  if max_depth < MsFolderInfo.DELTA_MIN_DEPTH:
+    stream_folder_download(
+        mgc, folder_info.path, dest_path, max_depth, pool, hasher,
+        compare_mode)
+  elif not delta_folder_download(
+          mgc, folder_info, dest_path, max_depth, pool, hasher, compare_mode):
+    lg.info(
+        f"[bulk_folder_download]Delta is not available for '{folder_path}'"
+        " - list folders one by one")
+    stream_folder_download(
+        mgc, folder_info.path, dest_path, max_depth, pool, hasher,
+        compare_mode)
+  result = pool.wait()
+  hasher.close()
+  return result
+
+
+@beartype
+def delta_folder_download(
+        mgc: MsGraphClient,
+        folder_info: MsFolderInfo,
+        dest_path: str,
+        depth: int = 999,
+        pool: Optional[TransferPool] = None,
+        hasher: quickxorhash = qxh,
+        compare_mode: str = "hash"):
+  """ Download the tree of a remote folder while it is enumerated with
+      delta. Downloads of a page are submitted as soon as it is received.
+      Return False if delta can not be used. Nothing has been downloaded then.
+  """
+  if pool is None:
+    pool = TransferPool()
+  if os.path.exists(dest_path) and not os.path.isdir(dest_path):
+    lg.error(
+        f"[delta_folder_download] {dest_path} exists and is not a folder"
+        " - skipping")
+    return True
+
+  enumerator = DeltaEnumerator(
+      mgc, None if folder_info.is_root else folder_info.ms_id,
+      folder_info.path)
+  local_folders = {""}   # relative paths of local folders which are ready
+  # ids of files whose download is submitted. A file may be given by several
+  # pages: it is downloaded once, in its state at the time of download
+  submitted_ids = set()
+  nb_pages = 0
+  try:
+    for page in enumerator.pages():
+      nb_pages += 1
+      if nb_pages == 1 and not os.path.exists(dest_path):
+        lg.info(
+            f"[delta_folder_download] {dest_path} does not exists - create it")
+        os.mkdir(dest_path)
+
+      files_by_folder = {}
+      for (relative_path, c) in page:
+        (parent_path, _, name) = relative_path.rpartition("/")
+        if parent_path not in local_folders:
+          continue   # Below maximum depth or parent can not be created
+        if 'folder' in c and relative_path.count("/") + 1 < depth:
+          local_path = f"{dest_path}/{relative_path}"
+          if os.path.exists(local_path) and not os.path.isdir(local_path):
+            lg.error(
+                f"[delta_folder_download] {local_path} exists and is not a"
+                " folder - skipping")
+            continue
+          elif not os.path.exists(local_path):
+            lg.info(
+                f"[delta_folder_download] {local_path} does not exists"
+                " - create it")
+            os.mkdir(local_path)
+          local_folders.add(relative_path)
+        elif 'file' in c and c['id'] not in submitted_ids:
+          submitted_ids.add(c['id'])
+          files_by_folder.setdefault(parent_path, []).append(c)
+
+      for (parent_path, files) in files_by_folder.items():
+        download_page(
+            mgc, files,
+            f"{folder_info.path}/{parent_path}" if parent_path != "" else (
+                folder_info.path),
+            f"{dest_path}/{parent_path}" if parent_path != "" else dest_path,
+            pool, hasher, compare_mode)
+  except DeltaError as e:
+    if nb_pages == 0:
+      return False
+    pool.report_failure(f"enumeration of {folder_info.path}", e)
+  return True
+
+
+@beartype
+def stream_folder_download(
+        mgc: MsGraphClient,
+        folder_path: str,
+        dest_path: str,
+        depth: int = 999,
+        pool: Optional[TransferPool] = None,
+        hasher: quickxorhash = qxh,
+        compare_mode: str = "hash"):
+  """ Download the tree of a remote folder while it is listed.
+
+      Children of folders are listed page by page. Downloads of a page are
+      submitted as soon as it is received, before next pages and subfolders
+      are listed. Only paths of folders which are still to be listed are kept
+      in memory.
+  """
+  if pool is None:
+    pool = TransferPool()
+  folders_to_be_listed = [(folder_path, dest_path, depth)]
+  while len(folders_to_be_listed) > 0:
+    (remote_path, local_path, depth) = folders_to_be_listed.pop()
+
+    if os.path.exists(local_path) and not os.path.isdir(local_path):
+      lg.error(
+          f"[stream_folder_download] {local_path} exists and is not a folder"
+          " - skipping")
+      continue
+    elif not os.path.exists(local_path):
+      lg.info(
+          f"[stream_folder_download] {local_path} does not exists - create it")
+      os.mkdir(local_path)
+
+    (page, next_link) = mgc.get_ms_response_for_children_folder_path(
+        remote_path)
+    while page is not None:
+      download_page(
+          mgc, page, remote_path, local_path, pool, hasher, compare_mode)
+      if depth > 1:
+        folders_to_be_listed.extend(
+            (f"{remote_path}/{c['name']}", f"{local_path}/{c['name']}",
+             depth - 1)
+            for c in reversed(page) if 'folder' in c)
+      if next_link is None:
+        break
+      (page, next_link) = (
+          mgc.get_ms_response_for_children_folder_path_from_link(next_link))
+
+    if page is None:
+      pool.report_failure(
+          f"listing of {remote_path}", Exception("children not retrieved"))
+
+
+def download_page(
+        mgc: MsGraphClient,
+        page: list,
+        remote_path: str,
+        local_path: str,
+        pool: TransferPool,
+        hasher: quickxorhash = qxh,
+        compare_mode: str = "hash"):
+  """ Submit downloads of the files of a page of children of remote_path
+  """
+  files_info = [
+      ObjectInfoFactory.MsFileInfoFromMgcResponse(
+          mgc, c, no_warn_if_no_parent=True, no_update_of_global_dict=True)
+      for c in page if 'file' in c]
+
+  # Hash local files of the page together
+  if isinstance(hasher, HashingStage):
+    hasher.prefetch(
+        f"{local_path}/{fi.name}" for fi in files_info
+        if compare_without_hash(
+            fi, f"{local_path}/{fi.name}", compare_mode) is None)
+
+  for file_info in files_info:
+    remote_file_path = f"{remote_path}/{file_info.name}"
+    if file_needs_download(file_info, local_path, hasher, compare_mode):
+      lg.info(
+          f"[download_page] download '{remote_file_path}'"
+          f" in '{local_path}'")
+      pool.submit(
+          f"download of {remote_file_path}",
+          download_file, mgc, remote_file_path, local_path)
+    else:
+      lg.debug(
+          f"[download_page] no need to download"
+          f" '{remote_file_path}' in '{local_path}'")
 
 
 @beartype
@@ -45,7 +292,12 @@ def mdownload_folder(
         mgc: MsGraphClient,
         ms_folder: MsFolderInfo,
         dest_path: str,
-        depth: int = 999):
+        depth: int = 999,
+        pool: Optional[TransferPool] = None,
+        hasher: quickxorhash = qxh,
+        compare_mode: str = "hash"):
+  if pool is None:
+    pool = TransferPool()
   if os.path.exists(dest_path) and not os.path.isdir(dest_path):
     lg.error(
         f"[mdownload_folder] {dest_path} exists and is not a folder"
@@ -58,10 +310,12 @@ def mdownload_folder(
     os.mkdir(dest_path)
 
   for file_info in ms_folder.children_file:
-    if file_needs_download(file_info, dest_path):
+    if file_needs_download(file_info, dest_path, hasher, compare_mode):
       lg.info(
           f"[mdownload_folder] download '{file_info.path}' in '{dest_path}'")
-      mgc.download_file_content(file_info.path, dest_path)
+      pool.submit(
+          f"download of {file_info.path}",
+          download_file, mgc, file_info.path, dest_path)
     else:
       lg.debug(
           f"[mdownload_folder] no need to download '{file_info.path}'"
@@ -70,32 +324,35 @@ def mdownload_folder(
   if depth > 1:
     for cf in ms_folder.children_folder:
       mdownload_folder(
-          mgc, cf, f"{dest_path}/{cf.name}", depth - 1)
+          mgc, cf, f"{dest_path}/{cf.name}", depth - 1, pool, hasher,
+          compare_mode)
 
   return True
 
 
+def download_file(mgc, src_file, dest_path):
+  if mgc.download_file_content(src_file, dest_path) != 1:
+    raise Exception("download has failed")
+
+
 @beartype
-def file_needs_download(ms_fileinfo: MsFileInfo, dest_path: str):
+def file_needs_download(
+        ms_fileinfo: MsFileInfo,
+        dest_path: str,
+        hasher: quickxorhash = qxh,
+        compare_mode: str = "hash"):
   local_file_name = f"{dest_path}/{ms_fileinfo.name}"
 
-  result = False
+  result = compare_without_hash(ms_fileinfo, local_file_name, compare_mode)
 
-  # Check if local file exists
-  if not os.path.exists(local_file_name):
-    result = True
-
-  # Check from quickxorhash if possible
-  if not result and ms_fileinfo.qxh is not None:
-    hash_qxh = qxh.quickxorhash(local_file_name)
+  # Check from quickxorhash if needed
+  if result is None:
+    hash_qxh = hasher.quickxorhash(local_file_name)
     lg.debug(
         f"[file_needs_download]qxh exists for '{ms_fileinfo.name}'"
         f" - '{hash_qxh}' vs '{ms_fileinfo.qxh}'")
     result = hash_qxh != ms_fileinfo.qxh
 
-  else:
-    result = True
-
   lg.debug(
       f"[file_needs_download] {local_file_name}"
       f" - {'True' if result else 'False'}")
@@ -107,10 +364,14 @@ def bulk_folder_upload(
         mgc: MsGraphClient,
         src_local_path: str,
         dst_remote_folder: str,
-        max_depth: int = 999):
+        max_depth: int = 999,
+        nb_jobs: int = 1,
+        hash_cache: Optional[HashCache] = None,
+        compare_mode: str = "hash"):
   lg.debug(
       f"[bulk_folder_upload]src_local_path = '{src_local_path}'"
-      f" - dst_remote_folder = {dst_remote_folder} - depth = '{max_depth}'")
+      f" - dst_remote_folder = {dst_remote_folder} - depth = '{max_depth}'"
+      f" - jobs = {nb_jobs} - compare = {compare_mode}")
   remote_object = ObjectInfoFactory.get_object_info(
       mgc, dst_remote_folder, no_warn_if_no_parent=True)
   if remote_object[0]:
@@ -126,48 +387,116 @@ def bulk_folder_upload(
         f"[bulk_folder_upload]{dst_remote_folder} exists but is not a folder"
         " - stop upload")
     return False
-  remote_folder_info.retrieve_children_info(recursive=True, depth=max_depth)
-  mupload_folder(mgc, remote_folder_info, src_local_path, depth=max_depth)
+  # Remote tree is enumerated once. Local tree is compared with it
+  manifest = RemoteManifest(mgc, remote_folder_info).build()
+
+  # Hash local files that could be compared while uploads are running
+  hasher = HashingStage(cache=hash_cache)
+  hasher.prefetch(
+      local_files_to_be_compared_for_upload(
+          manifest, "", src_local_path, max_depth, compare_mode))
+
+  pool = TransferPool(nb_jobs)
+  mupload_folder(
+      mgc, manifest, "", src_local_path, depth=max_depth, pool=pool,
+      hasher=hasher, compare_mode=compare_mode)
+  result = pool.wait()
+  hasher.close()
+  return result
+
+
+def local_files_to_be_compared_for_upload(
+        manifest: RemoteManifest,
+        relative_path: str,
+        src_path: str,
+        depth: int,
+        compare_mode: str = "hash"):
+  """ Generate names of local files of src_path tree of which hash is
+      needed to be compared with their remote counterpart
+  """
+  with os.scandir(src_path) as scan_dir:
+    for entry in scan_dir:
+      entry_relative_path = join_relative_path(relative_path, entry.name)
+      if entry.is_file():
+        ms_fileinfo = manifest.get_file(entry_relative_path)
+        local_file_name = f"{src_path}/{entry.name}"
+        if ms_fileinfo is not None and compare_without_hash(
+                ms_fileinfo, local_file_name, compare_mode) is None:
+          yield local_file_name
+      elif entry.is_dir() and depth > 0:
+        if manifest.is_folder(entry_relative_path):
+          yield from local_files_to_be_compared_for_upload(
+              manifest, entry_relative_path, entry.path, depth - 1,
+              compare_mode)
+
+
+def join_relative_path(relative_path, name):
+  return f"{relative_path}/{name}" if relative_path != "" else name
 
 
 @beartype
 def mupload_folder(
         mgc: MsGraphClient,
-        ms_folder: MsFolderInfo,
+        manifest: RemoteManifest,
+        relative_path: str,
         src_path: str,
-        depth: int = 999):
+        depth: int = 999,
+        pool: Optional[TransferPool] = None,
+        hasher: quickxorhash = qxh,
+        compare_mode: str = "hash"):
+  if pool is None:
+    pool = TransferPool()
+  remote_path = manifest.absolute_path(relative_path)
   lg.debug(
-      f"[mupload_folder]Starting. remote path = {ms_folder.path}"
+      f"[mupload_folder]Starting. remote path = {remote_path}"
       f" - src path = {src_path} - depth = {depth}")
-  ms_folder.retrieve_children_info(recursive=True, depth=depth)
   scan_dir = os.scandir(src_path)
   for entry in scan_dir:
+    entry_relative_path = join_relative_path(relative_path, entry.name)
 
     if entry.is_file():
-      if ms_folder.is_direct_child_folder(entry.name):
+      if manifest.is_folder(entry_relative_path):
         lg.warning(
             f"[mupload_folder]{entry.path} is a local file but is"
             " a remote folder. Skip it")
       else:
-        if file_needs_upload(src_path, entry.name, ms_folder):
+        if file_needs_upload(
+                f"{src_path}/{entry.name}",
+                manifest.get_file(entry_relative_path),
+                hasher, compare_mode):
           lg.info(f"[mupload_folder]Upload file {entry.path}")
-          mgc.put_file_content(
-              ms_folder.path, f"{src_path}/{entry.name}")
+          pool.submit(
+              f"upload of {entry.path}",
+              upload_file, mgc, remote_path, f"{src_path}/{entry.name}",
+              with_progress_bar=pool.nb_workers == 1,
+              # Times are compared by next uploads
+              with_mtime=compare_mode == "size-mtime")
 
     elif entry.is_dir():
 
-      if ms_folder.is_direct_child_file(entry.name):
+      if manifest.is_file(entry_relative_path):
         lg.warning(
             f"[mupload_folder]{entry.path} is a local folder but is a remote file."
             " Skip it")
       else:
-        sub_folder_info = ms_folder.get_child_folder(entry.name)
-        if sub_folder_info is None:
+        sub_folder_exists = manifest.is_folder(entry_relative_path)
+        if not sub_folder_exists:
           lg.info(f"[mupload_folder]{entry.path} does not exist. Create it")
-          sub_folder_info = ms_folder.create_empty_subfolder(entry.name)
-
-        if depth > 0:
-          mupload_folder(mgc, sub_folder_info, entry.path, depth - 1)
+          folder_json = mgc.create_folder(remote_path, entry.name)
+          if folder_json:
+            manifest.add(
+                entry_relative_path,
+                ObjectInfoFactory.MsFolderFromMgcResponse(
+                    mgc, folder_json, no_warn_if_no_parent=True))
+            sub_folder_exists = True
+
+        if not sub_folder_exists:
+          lg.error(
+              f"[mupload_folder]{entry.path} can not be created. Skip it")
+        elif depth > 0:
+          mupload_folder(
+              mgc, manifest, entry_relative_path, entry.path, depth - 1,
+              pool, hasher, compare_mode)
         else:
           lg.info(
               f"[mupload_folder]maxdepth is reach for folder {entry.path}."
@@ -181,24 +510,57 @@ def mupload_folder(
   return True
 
 
-@beartype
-def file_needs_upload(
-        src_folder_path: str,
-        str_file_name: str,
-        ms_remote_folder: MsFolderInfo):
-  str_local_file_name = f"{src_folder_path}/{str_file_name}"
+def upload_file(
+        mgc, dst_folder, src_file, with_progress_bar=True, with_mtime=False):
+  r = mgc.put_file_content(
+      dst_folder, src_file, with_progress_bar=with_progress_bar,
+      with_mtime=with_mtime)
+  if r.status_code not in (200, 201):
+    raise Exception(f"upload has failed with status code {r.status_code}")
 
-  if ms_remote_folder.is_direct_child_file(str_file_name):
-    hash_qxh = qxh.quickxorhash(str_local_file_name)
-    ms_fileinfo = ms_remote_folder.get_direct_child_file(str_file_name)
 
-    if ms_fileinfo.qxh is not None:
+@beartype
+def file_needs_upload(
+        str_local_file_name: str,
+        ms_fileinfo: Optional[MsFileInfo],
+        hasher: quickxorhash = qxh,
+        compare_mode: str = "hash"):
+  if ms_fileinfo is not None:
+    result = compare_without_hash(
+        ms_fileinfo, str_local_file_name, compare_mode)
+
+    if result is None:
+      hash_qxh = hasher.quickxorhash(str_local_file_name)
       lg.debug(
           f"[file_needs_upload]qxh exists for '{ms_fileinfo.name}'"
           f" - '{hash_qxh}' vs '{ms_fileinfo.qxh}'")
       result = ms_fileinfo.qxh != hash_qxh
-    else:
-      result = True
   else:
     result = True
   return result
+
+
+def compare_without_hash(
+        ms_fileinfo: MsFileInfo,
+        local_file_name: str,
+        compare_mode: str = "hash"):
+  """ Compare a local file and a remote file from their metadata.
+      Return True if files are different, False if they are considered as
+      identical and None if their hashes must be compared.
+  """
+  try:
+    st = os.stat(local_file_name)
+  except OSError:
+    return True   # Local file does not exist
+  if st.st_size != ms_fileinfo.size:
+    return True
+
+  if (compare_mode == "size-mtime"
+          and ms_fileinfo.fs_last_modified_datetime is not None):
+    remote_mtime = ms_fileinfo.fs_last_modified_datetime.timestamp()
+    if abs(st.st_mtime - remote_mtime) <= MTIME_TOLERANCE:
+      return False
+
+  if ms_fileinfo.qxh is None:
+    return True   # Nothing else to compare
+  return None
@@ -0,0 +1,55 @@
+#  Copyright 2019-2022 Jareth Lomson <jareth.lomson@gmail.com>
+#  This file is part of OneDrive Client Program which is released under MIT License
+#  See file LICENSE for full license details
+import logging
+import os
+import sqlite3
+from threading import Lock
+
+lg = logging.getLogger('odc.cache')
+
+
+class HashCache:
+  """ Hashes of local files stored in a SQLite database.
+
+      A hash is identified by device and inode of the file. It is valid as
+      long as size and modification time of the file have not changed.
+  """
+
+  NB_WRITES_BEFORE_COMMIT = 100
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.__lock = Lock()
+    self.__nb_pending_writes = 0
+    self.__db = sqlite3.connect(filename, check_same_thread=False)
+    self.__db.execute(
+        "CREATE TABLE IF NOT EXISTS qxh ("
+        " device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER,"
+        " hash TEXT, PRIMARY KEY (device, inode))")
+    self.__db.commit()
+
+  def get(self, st):
+    """ Return hash of file whose stat result is st. None if unknown
+    """
+    with self.__lock:
+      row = self.__db.execute(
+          "SELECT hash FROM qxh WHERE device = ? AND inode = ?"
+          " AND size = ? AND mtime_ns = ?",
+          (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+    return None if row is None else row[0]
+
+  def set(self, st, hash_value):
+    with self.__lock:
+      self.__db.execute(
+          "INSERT OR REPLACE INTO qxh VALUES (?, ?, ?, ?, ?)",
+          (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, hash_value))
+      self.__nb_pending_writes += 1
+      if self.__nb_pending_writes >= HashCache.NB_WRITES_BEFORE_COMMIT:
+        self.__db.commit()
+        self.__nb_pending_writes = 0
+
+  def close(self):
+    with self.__lock:
+      self.__db.commit()
+      self.__db.close()
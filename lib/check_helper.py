@@ -1,20 +1,85 @@
 #  Copyright 2019-2022 Jareth Lomson <jareth.lomson@gmail.com>
 #  This file is part of OneDrive Client Program which is released under MIT License
 #  See file LICENSE for full license details
+import base64
+import mmap
 import subprocess
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from shutil import which
+from threading import Lock
+
+try:
+  import numpy
+except Exception:
+  numpy = None
 
 
 class quickxorhash:
+  """ QuickXorHash of local files as computed by OneDrive.
+
+      Available backends:
+        numpy     in-process computation vectorized with numpy
+        python    in-process computation without numpy
+        external  'quickxorhash' command found in PATH
+
+      Default backend is numpy if numpy is installed, python otherwise.
+      If a cache is given (see HashCache), a hash is computed only if the file
+      has changed since the last computation.
+  """
 
   __COMMAND_NAME = 'quickxorhash'
 
-  def __init__(self):
+  WIDTH_IN_BYTES = 20  # 160 bits
+  SHIFT = 11
+  # Byte i of a file is xored at bit (i * SHIFT) % 160. SHIFT and 160 are
+  # coprime, so bytes whose position are equal modulo 160 are xored at the same
+  # place. Files are read by blocks which are a multiple of 160 bytes.
+  PERIOD = 160
+  BLOCK_SIZE = PERIOD * 65536  # 10 MiB
+
+  def __init__(self, backend=None, cache=None):
     self.program = which(self.__COMMAND_NAME)
+    if backend is None:
+      backend = "numpy" if numpy is not None else "python"
+    self.backend = backend
+    self.cache = cache
+
+  @staticmethod
+  def available_backends():
+    result = ["python"]
+    if numpy is not None:
+      result.append("numpy")
+    if which(quickxorhash.__COMMAND_NAME) is not None:
+      result.append("external")
+    return result
 
   def quickxorhash(self, filename):
+    if self.cache is None:
+      return self.__quickxorhash_no_cache(filename)
+
+    try:
+      st = os.stat(filename)
+    except OSError:
+      return None
+    result = self.cache.get(st)
+    if result is None:
+      result = self.__quickxorhash_no_cache(filename)
+      if result is not None:
+        self.cache.set(st, result)
+    return result
 
+  def __quickxorhash_no_cache(self, filename):
+    if self.backend == "external":
+      return self.__quickxorhash_external(filename)
+    else:
+      try:
+        return self.__quickxorhash_builtin(filename)
+      except OSError:
+        return None
+
+  def __quickxorhash_external(self, filename):
     if self.program is not None:
       p = subprocess.run([self.program, filename], stdout=subprocess.PIPE)
       if p.returncode != 0:
@@ -24,6 +89,83 @@ class quickxorhash:
     else:
       return None
 
+  def __quickxorhash_builtin(self, filename):
+    # row gathers the xor of all bytes by position modulo 160.
+    # Byte k of row is the xor of bytes whose position modulo 160 is k.
+    row = 0
+    with open(filename, 'rb') as f:
+      length = os.fstat(f.fileno()).st_size
+      if length > 0:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+          view = memoryview(mm)
+          for start in range(0, length, quickxorhash.BLOCK_SIZE):
+            block = view[start:start + quickxorhash.BLOCK_SIZE]
+            row ^= self.__xor_rows(block)
+            block.release()
+          view.release()
+
+    # Spread bytes of row in the 160 bits state
+    state = 0
+    mask = (1 << (quickxorhash.WIDTH_IN_BYTES * 8)) - 1
+    for k in range(quickxorhash.PERIOD):
+      b = (row >> (8 * k)) & 0xFF
+      if b != 0:
+        shift = (k * quickxorhash.SHIFT) % (quickxorhash.WIDTH_IN_BYTES * 8)
+        state ^= ((b << shift) & mask) | (
+            b >> (quickxorhash.WIDTH_IN_BYTES * 8 - shift))
+
+    # Xor length of file in the last 64 bits
+    digest = bytearray(state.to_bytes(quickxorhash.WIDTH_IN_BYTES, 'little'))
+    for (i, b) in enumerate(length.to_bytes(8, 'little')):
+      digest[quickxorhash.WIDTH_IN_BYTES - 8 + i] ^= b
+    return base64.b64encode(bytes(digest)).decode('ascii')
+
+  def __xor_rows(self, block):
+    """ Xor rows of 160 bytes of block. Block must start at a position
+        multiple of 160. Return result as an integer (little endian)
+    """
+    nb_rows = len(block) // quickxorhash.PERIOD
+    full_size = nb_rows * quickxorhash.PERIOD
+    # The last incomplete row is considered as padded with zeros
+    result = int.from_bytes(block[full_size:], 'little')
+
+    if nb_rows == 0:
+      return result
+
+    if self.backend == "numpy":
+      rows = numpy.frombuffer(block[:full_size], dtype=numpy.uint8)
+      rows = rows.reshape(nb_rows, quickxorhash.PERIOD)
+      return result ^ int.from_bytes(
+          numpy.bitwise_xor.reduce(rows, axis=0).tobytes(), 'little')
+
+    # Fold the block on itself until one row remains
+    x = int.from_bytes(block[:full_size], 'little')
+    while nb_rows > 1:
+      half_in_bits = (nb_rows // 2) * quickxorhash.PERIOD * 8
+      x = (x & ((1 << half_in_bits) - 1)) ^ (x >> half_in_bits)
+      nb_rows -= nb_rows // 2
+    return result ^ x
+
+  @staticmethod
+  def benchmark(filename, nb_loops=3):
+    """ Print duration of computation of hash of filename with each available
+        backend.
+    """
+    size = os.path.getsize(filename)
+    print(f"File {filename} - {size:,} bytes - {nb_loops} loop(s)")
+    for backend in quickxorhash.available_backends():
+      qxh = quickxorhash(backend)
+      durations = []
+      for i in range(nb_loops):
+        start = time.perf_counter()
+        result = qxh.quickxorhash(filename)
+        durations.append(time.perf_counter() - start)
+      best = min(durations)
+      throughput = size / best / 1048576 if best > 0 else 0
+      print(
+          f"  {backend:10}{result}  best = {best:8.3f} s"
+          f"  ({throughput:,.1f} MiB/s)")
+
   # How to get quickxorhash command
   #
   # git clone https://github.com/sndr-oss/quickxorhash-c.git
@@ -41,3 +183,70 @@ class quickxorhash:
   #
   # -- uninstallation --
   # git clean -dfX
+
+
+def _compute_quickxorhash(filename, backend):
+  """ Return (stat result, hash) of filename. Run by HashingStage workers
+  """
+  st = os.stat(filename)
+  return (st, quickxorhash(backend).quickxorhash(filename))
+
+
+class HashingStage(quickxorhash):
+  """ quickxorhash whose hashes are computed in advance by a pool of workers.
+
+      Hashes of files given to prefetch() are computed by a process pool (or a
+      thread pool with the external backend) while the caller goes on.
+      quickxorhash() returns the hash computed in advance if any.
+  """
+
+  def __init__(self, backend=None, cache=None, nb_workers=None):
+    super().__init__(backend, cache)
+    self.nb_workers = nb_workers if nb_workers is not None else (
+        os.cpu_count() or 1)
+    self.__executor = None
+    self.__futures = {}
+    self.__lock = Lock()
+
+  def prefetch(self, filenames):
+    for filename in filenames:
+      with self.__lock:
+        if filename in self.__futures:
+          continue
+      if self.cache is not None:
+        try:
+          if self.cache.get(os.stat(filename)) is not None:
+            continue
+        except OSError:
+          continue
+      if self.__executor is None:
+        self.__executor = (
+            ThreadPoolExecutor(max_workers=self.nb_workers)
+            if self.backend == "external" else
+            ProcessPoolExecutor(max_workers=self.nb_workers))
+      future = self.__executor.submit(
+          _compute_quickxorhash, filename, self.backend)
+      with self.__lock:
+        self.__futures[filename] = future
+
+  def quickxorhash(self, filename):
+    with self.__lock:
+      future = self.__futures.pop(filename, None)
+    if future is None:
+      return super().quickxorhash(filename)
+    try:
+      (st, result) = future.result()
+    except Exception:
+      return super().quickxorhash(filename)
+    if self.cache is not None and result is not None:
+      self.cache.set(st, result)
+    return result
+
+  def close(self):
+    if self.__executor is not None:
+      with self.__lock:
+        for future in self.__futures.values():
+          future.cancel()
+        self.__futures = {}
+      self.__executor.shutdown(wait=True)
+      self.__executor = None
@@ -0,0 +1,249 @@
+#  Copyright 2019-2022 Jareth Lomson <jareth.lomson@gmail.com>
+#  This file is part of OneDrive Client Program which is released under MIT License
+#  See file LICENSE for full license details
+import logging
+import mmap
+from threading import Thread
+
+lg = logging.getLogger('odc.chunk')
+
+
+class FileChunkReader:
+  """ Read chunks of a file.
+
+      Every chunk is read from disk when it is requested.
+  """
+
+  def __init__(self, filename):
+    self.fin = open(filename, 'rb')
+
+  def read(self, start, size):
+    self.fin.seek(start)
+    return self.fin.read(size)
+
+  def close(self):
+    self.fin.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+class ReadAheadChunkReader(FileChunkReader):
+  """ Read chunks of a file with a double buffer.
+
+      Once a chunk has been returned, the next one is read by a thread in the
+      second buffer while the first one is sent.
+      A chunk (or a part of a chunk) which is requested again is served from
+      the buffers without dropping the chunk read in advance.
+
+      Returned values are memoryviews of the buffers. They are valid until the
+      next call to read().
+  """
+
+  def __init__(self, filename):
+    super().__init__(filename)
+    self.__buffers = [bytearray(), bytearray()]
+    self.__chunks = [None, None]  # (start, size) of data hold by each buffer
+    self.__current = 0            # index of buffer returned by last read
+    self.__prefetch_thread = None
+    self.__prefetch_error = None
+
+  def read(self, start, size):
+    self.__wait_prefetch()
+
+    idx = self.__find(start, size)
+    if idx is None:
+      idx = self.__find_start(start)
+      if idx is not None:
+        # Chunk read in advance is smaller than requested size
+        self.__extend(idx, size)
+      else:
+        # Not read in advance. Use the buffer which has been previously
+        # returned to keep data which has been read in advance
+        lg.debug(
+            f"[ReadAheadChunkReader]read {start:,} - {size:,} from disk")
+        idx = self.__current
+        self.__fill(idx, start, size)
+    self.__current = idx
+    (chunk_start, chunk_size) = self.__chunks[idx]
+    offset = start - chunk_start
+    result = memoryview(self.__buffers[idx])[
+        offset:offset + min(size, chunk_size - offset)]
+
+    next_start = start + len(result)
+    if len(result) == size and self.__find(next_start, size) is None:
+      self.__prefetch_thread = Thread(
+          target=self.__prefetch, args=(1 - idx, next_start, size))
+      self.__prefetch_thread.start()
+    return result
+
+  def close(self):
+    self.__wait_prefetch()
+    super().close()
+
+  def __find(self, start, size):
+    for idx in (self.__current, 1 - self.__current):
+      if self.__chunks[idx] is not None:
+        (chunk_start, chunk_size) = self.__chunks[idx]
+        if chunk_start <= start and start + size <= chunk_start + chunk_size:
+          return idx
+    return None
+
+  def __find_start(self, start):
+    for idx in (self.__current, 1 - self.__current):
+      if self.__chunks[idx] is not None and self.__chunks[idx][0] == start:
+        return idx
+    return None
+
+  def __fill(self, idx, start, size):
+    self.__chunks[idx] = None
+    if len(self.__buffers[idx]) < size:
+      self.__buffers[idx] = bytearray(size)
+    nb_read = self.__read_into(idx, start, 0, size)
+    self.__chunks[idx] = (start, nb_read)
+
+  def __extend(self, idx, size):
+    (chunk_start, chunk_size) = self.__chunks[idx]
+    if len(self.__buffers[idx]) < size:
+      new_buffer = bytearray(size)
+      new_buffer[:chunk_size] = self.__buffers[idx][:chunk_size]
+      self.__buffers[idx] = new_buffer
+    nb_read = self.__read_into(
+        idx, chunk_start + chunk_size, chunk_size, size)
+    self.__chunks[idx] = (chunk_start, chunk_size + nb_read)
+
+  def __read_into(self, idx, file_offset, buffer_start, buffer_end):
+    """ Read file from file_offset in buffer idx between buffer_start and
+        buffer_end. Return number of read bytes.
+    """
+    self.fin.seek(file_offset)
+    view = memoryview(self.__buffers[idx])[buffer_start:buffer_end]
+    nb_read = 0
+    while nb_read < len(view):
+      n = self.fin.readinto(view[nb_read:])
+      if not n:  # End of file
+        break
+      nb_read += n
+    return nb_read
+
+  def __prefetch(self, idx, start, size):
+    try:
+      self.__fill(idx, start, size)
+    except Exception as e:
+      self.__prefetch_error = e
+
+  def __wait_prefetch(self):
+    if self.__prefetch_thread is not None:
+      self.__prefetch_thread.join()
+      self.__prefetch_thread = None
+    if self.__prefetch_error is not None:
+      lg.warning(
+          f"[ReadAheadChunkReader]Error while reading in advance"
+          f" - {self.__prefetch_error}")
+      self.__prefetch_error = None
+
+
+class MmapChunkReader(FileChunkReader):
+  """ Read chunks of a file mapped in memory.
+
+      Chunks are memoryviews of the mapped file. No copy is done and a chunk
+      which is requested again is just a new view.
+      If the file can not be mapped, chunks are read as FileChunkReader does.
+  """
+
+  def __init__(self, filename):
+    super().__init__(filename)
+    self.__view = None
+    self.__last_chunk = None
+    try:
+      self.__mmap = mmap.mmap(self.fin.fileno(), 0, access=mmap.ACCESS_READ)
+      self.__view = memoryview(self.__mmap)
+    except (ValueError, OSError) as e:
+      lg.warning(
+          f"[MmapChunkReader]{filename} can not be mapped in memory - {e}")
+      self.__mmap = None
+
+  def read(self, start, size):
+    if self.__mmap is None:
+      return super().read(start, size)
+    self.__release_last_chunk()
+    self.__last_chunk = self.__view[start:start + size]
+    return self.__last_chunk
+
+  def __release_last_chunk(self):
+    if self.__last_chunk is not None:
+      self.__last_chunk.release()
+      self.__last_chunk = None
+
+  def close(self):
+    if self.__mmap is not None:
+      self.__release_last_chunk()
+      self.__view.release()
+      try:
+        self.__mmap.close()
+      except BufferError:
+        # A chunk is still referenced. Mapping will be closed by garbage
+        # collector
+        lg.debug("[MmapChunkReader]mapping can not be closed now")
+    super().close()
+
+
+class FragmentSizer:
+  """ Size of fragments sent during an upload session.
+
+      Fragment size must be a multiple of 320 KiB and lower than 60 MiB.
+      If fixed_size is not set, size is adapted from measured throughput so
+      that a fragment is sent in about TARGET_DURATION seconds. Size is halved
+      after an error and does not grow while errors are frequent.
+  """
+  UNIT = 327680                 # 320 KiB
+  MIN_SIZE = UNIT
+  MAX_SIZE = UNIT * 191         # Just under 60 MiB
+  DEFAULT_SIZE = UNIT * 64      # 20 MiB
+  TARGET_DURATION = 10          # seconds
+  MAX_ERROR_RATE_TO_GROW = 0.1
+
+  def __init__(self, fixed_size=None):
+    self.__fixed = fixed_size is not None
+    self.size = FragmentSizer.DEFAULT_SIZE if fixed_size is None else (
+        FragmentSizer.__bound(fixed_size))
+    self.__error_rate = 0.0  # exponential moving average of errors
+    self.__alpha = 0.3
+
+  @staticmethod
+  def __bound(size):
+    size = size - size % FragmentSizer.UNIT
+    return min(max(size, FragmentSizer.MIN_SIZE), FragmentSizer.MAX_SIZE)
+
+  def success(self, nb_bytes, duration):
+    self.__error_rate = (1 - self.__alpha) * self.__error_rate
+    if self.__fixed or duration <= 0:
+      return
+    throughput = nb_bytes / duration
+    new_size = min(throughput * FragmentSizer.TARGET_DURATION, self.size * 2)
+    if new_size > self.size and (
+            self.__error_rate > FragmentSizer.MAX_ERROR_RATE_TO_GROW):
+      new_size = self.size
+    new_size = FragmentSizer.__bound(int(max(new_size, self.size / 2)))
+    if new_size != self.size:
+      lg.debug(
+          f"[FragmentSizer]throughput = {throughput:,.0f} B/s"
+          f" - fragment size {self.size:,} -> {new_size:,}")
+      self.size = new_size
+
+  def failure(self):
+    self.__error_rate = (
+        self.__alpha + (1 - self.__alpha) * self.__error_rate)
+    if not self.__fixed:
+      self.size = FragmentSizer.__bound(self.size // 2)
+      lg.debug(f"[FragmentSizer]error - fragment size -> {self.size:,}")
+
+
+CHUNK_READERS = {
+    "plain": FileChunkReader,
+    "readahead": ReadAheadChunkReader,
+    "mmap": MmapChunkReader
+}
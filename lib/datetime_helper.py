@@ -19,3 +19,10 @@ def utc_dt_from_str_ms_datetime(str_ms_datetime):
 
 def utc_dt_now():
   return datetime.datetime.now(pytz.utc)
+
+
+def str_ms_datetime_from_timestamp(timestamp):
+  """ string representation of datetime for ms graph from a posix timestamp
+  """
+  return datetime.datetime.fromtimestamp(timestamp, pytz.utc).strftime(
+      "%Y-%m-%dT%H:%M:%SZ")
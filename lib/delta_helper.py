@@ -0,0 +1,110 @@
+#  Copyright 2019-2022 Jareth Lomson <jareth.lomson@gmail.com>
+#  This file is part of OneDrive Client Program which is released under MIT License
+#  See file LICENSE for full license details
+import logging
+
+from lib.graph_helper import MsGraphClient
+
+lg = logging.getLogger('odc.delta')
+
+
+class DeltaError(Exception):
+  pass
+
+
+class DeltaEnumerator:
+  """ Enumeration of the tree of a remote folder with the delta endpoint.
+
+      A delta page holds up to thousands of items of the whole tree, whereas
+      a children page holds items of one folder only.
+      Items are given page by page with their path relative to the folder.
+      Delta does not give the path of parents as children listing does. If
+      the path of the folder is known, it is set in parentReference of items.
+      Pages are not sorted: an item whose parent has not been seen yet is kept
+      aside until its parent arrives. Items outside of the folder tree are
+      dropped.
+      An item may appear several times in the enumeration. Its last
+      occurrence is its current state. Within a page, only this occurrence
+      is given. Users must expect an item given by a page to be given again
+      by a later one.
+  """
+
+  def __init__(self, mgc: MsGraphClient, ms_id=None, folder_path=None):
+    """ ms_id is the id of the folder. None for the root of the drive.
+        folder_path is the path of the folder ("" for the root of the drive)
+    """
+    self.mgc = mgc
+    self.ms_id = ms_id
+    self.folder_path = folder_path
+    self.delta_link = None
+    self.nb_requests = 0
+    self.__folder_paths = {}  # id of a folder -> relative path
+    self.__pending = {}       # id of an unknown parent -> items
+
+  def pages(self):
+    """ Generate lists of (relative path, item json) until the end of the
+        enumeration. Raise DeltaError if delta can not be used.
+        Deleted items are ignored.
+    """
+    index = self.mgc.drive_index
+    if (index is not None and self.folder_path is not None
+            and index.is_ready()):
+      # Tree is read from the drive index. No request is sent
+      yield from index.subtree_pages(self.ms_id, self.folder_path)
+      return
+
+    if self.ms_id is not None:
+      self.__folder_paths[self.ms_id] = ""
+    (page, next_link, delta_link) = self.mgc.get_ms_response_for_delta(
+        self.ms_id)
+    self.nb_requests += 1
+    while True:
+      if page is None:
+        raise DeltaError(
+            f"delta enumeration of {self.ms_id or 'root'} has failed")
+      yield self.__resolve(page)
+      if next_link is None:
+        break
+      (page, next_link, delta_link) = self.mgc.get_ms_response_for_delta(
+          link=next_link)
+      self.nb_requests += 1
+
+    self.delta_link = delta_link
+    nb_dropped = sum(len(items) for items in self.__pending.values())
+    if nb_dropped > 0:
+      lg.debug(f"[DeltaEnumerator]{nb_dropped} items outside of the tree")
+    self.__pending = {}
+
+  def __resolve(self, page):
+    result = []
+    # Last occurrence of an item replaces previous ones
+    for item in {item['id']: item for item in page}.values():
+      if 'deleted' in item:
+        continue
+      if item['id'] == self.ms_id or (self.ms_id is None and 'root' in item):
+        self.__add_resolved_folder(item['id'], "", result)
+        continue
+      parent_id = item.get('parentReference', {}).get('id')
+      if parent_id in self.__folder_paths:
+        self.__add_resolved_item(item, self.__folder_paths[parent_id], result)
+      else:
+        self.__pending.setdefault(parent_id, []).append(item)
+    return result
+
+  def __add_resolved_item(self, item, parent_path, result):
+    path = f"{parent_path}/{item['name']}" if parent_path != "" else (
+        item['name'])
+    if self.folder_path is not None:
+      item['parentReference'] = dict(
+          item.get('parentReference', {}),
+          path=f"/drive/root:{self.folder_path}"
+          + (f"/{parent_path}" if parent_path != "" else ""))
+    result.append((path, item))
+    if 'folder' in item:
+      self.__add_resolved_folder(item['id'], path, result)
+
+  def __add_resolved_folder(self, ms_id, path, result):
+    self.__folder_paths[ms_id] = path
+    # Children which have arrived before their parent
+    for item in self.__pending.pop(ms_id, []):
+      self.__add_resolved_item(item, path, result)
@@ -3,12 +3,19 @@
 #  See file LICENSE for full license details
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from requests_oauthlib import OAuth2Session
+from lib.chunk_helper import CHUNK_READERS, FragmentSizer
+from lib.datetime_helper import (str_ms_datetime_from_timestamp,
+                                 utc_dt_from_str_ms_datetime)
 from lib.strpathutil import StrPathUtil
 import json
+import math
 import os
 import pprint
+import requests
 import time
+from threading import Lock
 
 try:
   from tqdm import tqdm
@@ -18,6 +25,11 @@ except Exception:
 lg = logging.getLogger("odc.msgraph")
 
 
+class RangeIgnoredError(Exception):
+  """ Server has sent the whole content instead of a range of it """
+  pass
+
+
 class MsGraphClient:
 
   # TODO Implement copy feature
@@ -26,8 +38,15 @@ class MsGraphClient:
 
   (TYPE_NONE, TYPE_FILE, TYPE_FOLDER) = (0, 1, 2)
 
-  def __init__(self, mgc: OAuth2Session):
+  def __init__(self, mgc: OAuth2Session, upload_journal=None):
     self.mgc = mgc
+    self.upload_journal = upload_journal
+    self.drive_index = None   # See DriveIndex
+
+  def __drive_is_changed(self):
+    # Drive index must be refreshed before being used again
+    if self.drive_index is not None:
+      self.drive_index.dirty = True
 
   def get_user(self):
     # Send GET to /me
@@ -51,10 +70,17 @@ class MsGraphClient:
     return events.json()
 
   def get_ms_response_for_children_folder_path(
-          self, folder_path, only_folder=False):
+          self, folder_path, only_folder=False, use_index=True):
     """ Get response value of ms graph for getting children info of a onedrive folder from folder path
+        use_index   children are read from the drive index if any. Set it to
+                    False to get the current state of the folder on server
     """
 
+    if self.drive_index is not None and use_index:
+      result = self.drive_index.get_children(folder_path, only_folder)
+      if result is not None:
+        return (result, None)
+
     # folder_path must start with '/'
     if folder_path == '':
       fp = f"{MsGraphClient.graph_url}/me/drive/root/children"
@@ -89,36 +115,251 @@ class MsGraphClient:
 
     return (ms_response_json['value'], next_link)
 
+  def get_all_children_of_folder_path(
+          self, folder_path, only_folder=False, use_index=True):
+    """ Get children info of a onedrive folder from all pages of its
+        listing. Return None if an error occurs.
+    """
+    (result, next_link) = self.get_ms_response_for_children_folder_path(
+        folder_path, only_folder, use_index)
+    while result is not None and next_link is not None:
+      (page, next_link) = (
+          self.get_ms_response_for_children_folder_path_from_link(
+              next_link, only_folder))
+      if page is None:
+        return None
+      result.extend(page)
+    return result
 
-  def download_file_content(self, dst_path, local_dst):
+  def get_ms_response_for_delta(self, ms_id=None, link=None):
+    """ Get a page of the delta enumeration of the tree of item ms_id (whole
+        drive if None), or the page given by link (next link or delta link).
+        Return (items, next_link, delta_link). items is None if an error
+        occurs. Items of a delta page hold no path in their parentReference.
+    """
+    if link is None:
+      if ms_id is None:
+        link = f"{MsGraphClient.graph_url}/me/drive/root/delta"
+      else:
+        link = f"{MsGraphClient.graph_url}/me/drive/items/{ms_id}/delta"
+
+    ms_response_json = self.mgc.get(link).json()
+    if 'error' in ms_response_json:
+      lg.debug(
+          f"[get_ms_response_for_delta]{link}"
+          f" - error {ms_response_json['error'].get('code')}")
+      return (None, None, None)
+
+    return (
+        ms_response_json['value'],
+        ms_response_json.get("@odata.nextLink"),
+        ms_response_json.get("@odata.deltaLink"))
+
+
+  def download_file_content(self, dst_path, local_dst, nb_connections=1):
+    """ Download a remote file in local_dst.
+
+        Content is written in a '.partial' file which is renamed once the
+        download is complete. A resume record is stored beside it so that an
+        interrupted download is continued from where it stopped.
+        When nb_connections > 1, a large file is split in byte ranges which
+        are fetched simultaneously and written at their offset in the local
+        file.
+        Return 1 if download is OK, 0 otherwise.
+    """
     # Inspired from https://gist.github.com/mvpotter/9088499
+    dst_path = StrPathUtil.remove_first_char_if_necessary(dst_path, "/")
 
-    r = self.mgc.get(
-        f"{MsGraphClient.graph_url}/me/drive/root:/{dst_path}:/content",
-        stream=True)
+    r = self.mgc.get(f"{MsGraphClient.graph_url}/me/drive/root:/{dst_path}")
+    if r.status_code != 200:
+      lg.error(
+          f"[download_file_content] Download of file '{dst_path}'"
+          f" - error code {r.status_code}")
+      return 0
+    r_json = r.json()
+    if 'file' not in r_json or "@microsoft.graph.downloadUrl" not in r_json:
+      lg.error(
+          f"[download_file_content] Download of file '{dst_path}'"
+          " - not a file or no content to be downloaded")
+      return 0
+    total_size = r_json["size"]
+    download_url = r_json["@microsoft.graph.downloadUrl"]
 
     if os.path.isdir(local_dst):
       file_name = dst_path.split("/").pop()
       local_filepath = f"{local_dst}/{file_name}"
     else:
       local_filepath = local_dst
+    partial_filepath = f"{local_filepath}.partial"
+
+    record = self.ResumeRecord.load(
+        f"{partial_filepath}.json", r_json["id"], r_json["eTag"], total_size)
+    if (record is not None and os.path.isfile(partial_filepath)
+            and os.path.getsize(partial_filepath) == total_size):
+      lg.info(
+          f"[download_file_content] Resume download of '{dst_path}'"
+          f" - {record.bytes_done():,} bytes already downloaded")
+    else:
+      record = MsGraphClient.__new_download(
+          partial_filepath, r_json, nb_connections)
+
+    errors = self.__download_segments(
+        dst_path, download_url, partial_filepath, record)
+    if any(isinstance(e, RangeIgnoredError) for e in errors):
+      # Content can only be downloaded at once
+      lg.info(
+          f"[download_file_content] {dst_path} - ranges are ignored by server"
+          " - download whole file")
+      record = MsGraphClient.__new_download(partial_filepath, r_json, 1)
+      errors = self.__download_segments(
+          dst_path, download_url, partial_filepath, record)
+    if len(errors) > 0:
+      lg.error(
+          f"[download_file_content] Download of file '{dst_path}'"
+          f" - {len(errors)} segment(s) in error - {errors[0]}")
+      return 0
+
+    os.replace(partial_filepath, local_filepath)
+    record.remove()
+    MsGraphClient.__set_local_mtime(local_filepath, r_json)
+    lg.info(
+        f"[download_file_content] Download of file '{dst_path }' to '{local_dst}' - OK")
+
+    return 1
 
+  @staticmethod
+  def __new_download(partial_filepath, r_json, nb_connections):
+    """ Start download of item r_json from scratch. Return its record """
+    total_size = r_json["size"]
+    record = MsGraphClient.ResumeRecord(
+        f"{partial_filepath}.json", r_json["id"], r_json["eTag"], total_size,
+        MsGraphClient.split_in_segments(total_size, nb_connections))
+    # Preallocate local file so that each segment is written at its offset
+    with open(partial_filepath, 'wb') as f:
+      f.truncate(total_size)
+    record.store()
+    return record
+
+  def __download_segments(
+          self, dst_path, download_url, partial_filepath, record):
+    """ Download remaining segments of record. Return errors """
+    segments = record.remaining_segments()
+    lg.debug(
+        f"[download_file_content] {dst_path} - size = {record.size:,}"
+        f" - {len(segments)} segment(s) to be downloaded")
+
+    if len(segments) <= 1:
+      try:
+        for (num_segment, start, end) in segments:
+          self.__download_segment(
+              dst_path, download_url, partial_filepath,
+              record, num_segment, start, end)
+        errors = []
+      except Exception as e:
+        errors = [e]
+    else:
+      with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [
+            executor.submit(
+                self.__download_segment,
+                dst_path, download_url, partial_filepath,
+                record, num_segment, start, end)
+            for (num_segment, start, end) in segments]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+    return errors
+
+  def __download_segment(
+          self, dst_path, download_url, local_filepath,
+          record, num_segment, start, end):
     CHUNK_SIZE = 1048576 * 20  # 20 MB
-    start = 0
-    with open(local_filepath, 'wb') as f:
+
+    # download_url is pre-authenticated. No need to use oauth session
+    r = requests.get(
+        download_url,
+        headers={'Range': f"bytes={start}-{end}"},
+        stream=True)
+    if r.status_code == 200:  # OK - Range is ignored by server
+      # Whole content is sent: it is only usable for a range covering the
+      # whole file
+      if start != 0 or end != record.size - 1:
+        r.close()
+        raise RangeIgnoredError(
+            f"range {start}->{end} - range is ignored by server")
+    elif r.status_code != 206:  # Partial Content
+      raise Exception(
+          f"range {start}->{end} - error code {r.status_code}")
+    elif (r.headers.get('Content-Range', "").split("/")[0]
+          != f"bytes {start}-{end}"):
+      r.close()
+      raise Exception(
+          f"range {start}->{end} - unexpected content range"
+          f" '{r.headers.get('Content-Range')}'")
+
+    current = start
+    with open(local_filepath, 'r+b') as f:
+      f.seek(start)
       for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
         if chunk:  # filter out keep-alive new chunks
+          if current + len(chunk) > end + 1:
+            # Bytes after the range are not written
+            r.close()
+            raise Exception(
+                f"range {start}->{end} - more than {end + 1 - start} bytes"
+                " received")
           lg.info(
-              f"[download_file_content] Downloading {dst_path} from {start}")
+              f"[download_file_content] Downloading {dst_path} from {current}")
           f.write(chunk)
           f.flush()
-          start = start + CHUNK_SIZE
-    lg.info(
-        f"[download_file_content] Download of file '{dst_path }' to '{local_dst}' - OK")
+          current = current + len(chunk)
+          record.update(num_segment, current)
 
-    return 1
+    if current != end + 1:
+      raise Exception(
+          f"range {start}->{end} - only {current - start} bytes received")
+
+  @staticmethod
+  def __set_local_mtime(local_filepath, ms_response_json):
+    """ Set modification time of local file to the one of the file system
+        where the remote file comes from.
+    """
+    fs_info = ms_response_json.get('fileSystemInfo', {})
+    if 'lastModifiedDateTime' not in fs_info:
+      return
+    try:
+      mtime = utc_dt_from_str_ms_datetime(
+          fs_info['lastModifiedDateTime']).timestamp()
+      os.utime(local_filepath, (mtime, mtime))
+    except (ValueError, OSError) as e:
+      lg.warning(
+          f"[download_file_content] Unable to set modification time of"
+          f" '{local_filepath}' - {e}")
+
+  @staticmethod
+  def file_system_info(src_file):
+    """ fileSystemInfo facet holding modification time of src_file
+    """
+    return {
+        "lastModifiedDateTime": str_ms_datetime_from_timestamp(
+            os.path.getmtime(src_file))
+    }
+
+  @staticmethod
+  def split_in_segments(total_size, nb_segments):
+    """ Split [0, total_size[ in at most nb_segments ranges (start, end).
+        Each range is at least SEGMENT_MIN_SIZE bytes long except the last one
+    """
+    SEGMENT_MIN_SIZE = 1048576 * 8  # 8 MB
+    if total_size == 0:
+      return []
+    nb_segments = max(
+        1, min(nb_segments, math.ceil(total_size / SEGMENT_MIN_SIZE)))
+    segment_size = math.ceil(total_size / nb_segments)
+    return [
+        (start, min(start + segment_size, total_size) - 1)
+        for start in range(0, total_size, segment_size)]
 
   def delete_file(self, file_path):
+    self.__drive_is_changed()
     file_path = StrPathUtil.add_first_char_if_necessary(file_path, "/")
     r = self.mgc.delete(
         f"{MsGraphClient.graph_url}/me/drive/root:{file_path}:")
@@ -138,8 +379,21 @@ class MsGraphClient:
           dst_folder,
           src_file,
           dst_file=None,
-          with_progress_bar=True):
+          with_progress_bar=True,
+          chunk_reader="readahead",
+          chunk_size=None,
+          with_mtime=False):
+    """ Upload src_file in dst_folder.
+
+        Large files are uploaded by chunks through an upload session.
+        chunk_reader is the way chunks are read from disk (see CHUNK_READERS)
+        chunk_size is the fixed size of chunks. If None, size is adapted to
+        the measured throughput (see FragmentSizer)
+        with_mtime: modification time of a small file is set after its
+        upload, with one more request. It is always set for large files
+    """
     lg.info(f"Start put_file_content('{dst_folder}','{src_file}')")
+    self.__drive_is_changed()
 
     dst_folder = StrPathUtil.remove_first_char_if_necessary(dst_folder, "/")
     total_size = os.path.getsize(src_file)
@@ -163,30 +417,71 @@ class MsGraphClient:
             data=f,
             headers=headers)
 
+      if with_mtime and r.status_code in (200, 201):
+        # Simple upload can not carry properties. Set modification time of
+        # local file afterwards
+        r_patch = self.mgc.patch(
+            f"{MsGraphClient.graph_url}/me/drive/items/{r.json()['id']}",
+            headers={'Content-Type': 'application/json'},
+            data=json.dumps(
+                {"fileSystemInfo": MsGraphClient.file_system_info(src_file)}))
+        if r_patch.status_code != 200:
+          lg.warning(
+              f"Unable to set fileSystemInfo of '{file_name}'"
+              f" - error code {r_patch.status_code}")
+
       return r
 
     else:
       # For file size > 4 Mb
       # https://docs.microsoft.com/fr-fr/graph/api/driveitem-createuploadsession?view=graph-rest-1.0
-      url = f"{MsGraphClient.graph_url}/me/drive/root:/{dst_folder}/{file_name}:/createUploadSession"
-      data = {
-          "item": {
-              "@odata.type": "microsoft.graph.driveItemUploadableProperties",
-              "@microsoft.graph.conflictBehavior": "replace"
-          }
-      }
+      dst_path = f"{dst_folder}/{file_name}"
+      current_start = 0
 
-      # Initiate upload session
-      data_json = json.dumps(data)
-      r1 = self.mgc.post(
-          url,
-          headers={
-              'Content-Type': 'application/json'
-          },
-          data=data_json
-      )
-      r1_json = r1.json()
-      uurl = r1_json["uploadUrl"]
+      # Continue upload session stored in journal if possible
+      uurl = None
+      if self.upload_journal is not None:
+        uurl = self.upload_journal.get_upload_url(dst_path, src_file)
+      if uurl is not None:
+        r1 = self.mgc.get(uurl)
+        if r1.status_code == 200 and len(
+                r1.json().get('nextExpectedRanges', [])) > 0:
+          ner = r1.json()['nextExpectedRanges'][0]
+          current_start = int(ner[:ner.find('-')])
+          lg.info(
+              f"Continue upload session of '{dst_path}' from {current_start:,}")
+        else:
+          lg.info(
+              f"Upload session of '{dst_path}' can not be continued"
+              f" (status code {r1.status_code}). Create a new one")
+          self.upload_journal.remove(dst_path)
+          uurl = None
+
+      if uurl is None:
+        url = f"{MsGraphClient.graph_url}/me/drive/root:/{dst_path}:/createUploadSession"
+        data = {
+            "item": {
+                "@odata.type": "microsoft.graph.driveItemUploadableProperties",
+                "@microsoft.graph.conflictBehavior": "replace",
+                "fileSystemInfo": MsGraphClient.file_system_info(src_file)
+            }
+        }
+
+        # Initiate upload session
+        data_json = json.dumps(data)
+        r1 = self.mgc.post(
+            url,
+            headers={
+                'Content-Type': 'application/json'
+            },
+            data=data_json
+        )
+        r1_json = r1.json()
+        uurl = r1_json["uploadUrl"]
+        if self.upload_journal is not None:
+          self.upload_journal.add(
+              dst_path, src_file, uurl,
+              r1_json.get("expirationDateTime"))
 
       # Upload parts of file
       total_size = os.path.getsize(src_file)
@@ -199,15 +494,15 @@ class MsGraphClient:
             total=total_size,
             unit="B",
             unit_scale=True,
-            unit_divisor=1024)
+            unit_divisor=1024,
+            initial=current_start)
       else:
         pbar = None
 
-      CHUNK_SIZE = 1048576 * 20  # 20 MB
-      current_start = 0
+      sizer = FragmentSizer(chunk_size)
 
-      if total_size >= current_start + CHUNK_SIZE:
-        current_end = current_start + CHUNK_SIZE - 1
+      if total_size >= current_start + sizer.size:
+        current_end = current_start + sizer.size - 1
       else:
         current_end = total_size - 1
       current_size = current_end - current_start + 1
@@ -217,10 +512,10 @@ class MsGraphClient:
 
       simu_error = 0 == 1  # No simulation of error
 
-      with open(src_file, 'rb') as fin:
+      with CHUNK_READERS[chunk_reader](src_file) as reader:
         i = 0
         while True:
-          current_stream = fin.read(current_size)
+          current_stream = reader.read(current_start, current_size)
 
           if not current_stream:
             stop_reason = "end_of_stream"
@@ -249,6 +544,7 @@ class MsGraphClient:
 
           #simu_error = i==5
           if not simu_error:
+            start_time = time.monotonic()
             r = self.mgc.put(
                 uurl,
                 headers=headers,
@@ -273,19 +569,21 @@ class MsGraphClient:
               lg.info(f"Wait {retry_status.delay_wait()} seconds")
               ner = r.json()['nextExpectedRanges'][0]
               current_start = int(ner[:ner.find('-')])
-              if total_size >= current_start + CHUNK_SIZE:
-                current_end = current_start + CHUNK_SIZE - 1
+              sizer.failure()
+              if total_size >= current_start + sizer.size:
+                current_end = current_start + sizer.size - 1
               else:
                 current_end = total_size - 1
               current_size = current_end - current_start + 1
               time.sleep(retry_status.delay_wait())
-              fin.seek(current_start)
             else:
               raise Exception("Maximum retry reached after an error")
 
           elif status_code_put == 404:  # Not found. Upload session no longer exists
             lg.error(
                 "Upload session no longer exists (error code 404). Stop upload")
+            if self.upload_journal is not None:
+              self.upload_journal.remove(dst_path)
             raise Exception(
                 "Upload session no longer exists. Please relaunch upload. Current range: {0}->{1}.".format(
                     current_start, current_end))
@@ -305,9 +603,10 @@ class MsGraphClient:
           else:  # status_code_put in (202, 201, 200)
             if pbar is not None:
               pbar.update(current_size)
+            sizer.success(current_size, time.monotonic() - start_time)
             current_start = current_end + 1
-            if total_size >= current_start + CHUNK_SIZE:
-              current_end = current_start + CHUNK_SIZE - 1
+            if total_size >= current_start + sizer.size:
+              current_end = current_start + sizer.size - 1
             else:
               current_end = total_size - 1
             current_size = current_end - current_start + 1
@@ -325,6 +624,8 @@ class MsGraphClient:
 
       # Close URL
       self.cancel_upload(uurl)
+      if self.upload_journal is not None:
+        self.upload_journal.remove(dst_path)
 
       lg.info(f"Session is finish - Stop_reason = {stop_reason}")
       r = r1
@@ -340,6 +641,7 @@ class MsGraphClient:
       If successfull, return the name of the new folder.
       Else return none
     """
+    self.__drive_is_changed()
     dst_path = StrPathUtil.remove_first_char_if_necessary(dst_path, "/")
     if dst_path == '':
       dst_url = f"{MsGraphClient.graph_url}/me/drive/root:/children"
@@ -394,6 +696,7 @@ class MsGraphClient:
 
   def move_object(self, src_path: str, dst_path: str):
     lg.info(f"[move]Entering move_object ({src_path},{dst_path})")
+    self.__drive_is_changed()
 
     src_path = StrPathUtil.remove_first_char_if_necessary(src_path, '/')
     dst_path = StrPathUtil.remove_first_char_if_necessary(dst_path, '/')
@@ -468,6 +771,83 @@ class MsGraphClient:
   def close(self):
     self.mgc.close()
 
+  class ResumeRecord:
+    """ Progress of a download stored beside the '.partial' file.
+
+        For each segment, the record keeps the offset of the next byte to be
+        downloaded.
+    """
+
+    def __init__(self, filename, ms_id, etag, size, segments):
+      self.filename = filename
+      self.ms_id = ms_id
+      self.etag = etag
+      self.size = size
+      # list of [start, end, next offset to be downloaded]
+      self.segments = [[start, end, start] for (start, end) in segments]
+      self.__lock = Lock()
+
+    @classmethod
+    def load(cls, filename, ms_id, etag, size):
+      """ Return the stored record if it matches the remote item.
+          Return None otherwise
+      """
+      try:
+        with open(filename, 'r') as f:
+          r_json = json.load(f)
+      except (OSError, ValueError):
+        return None
+      if (r_json.get("id") != ms_id or r_json.get("eTag") != etag
+              or r_json.get("size") != size):
+        lg.info(f"[ResumeRecord]{filename} is obsolete. Ignore it")
+        return None
+      result = cls(filename, ms_id, etag, size, [])
+      result.segments = r_json["segments"]
+      for segment in result.segments:
+        (start, end, current) = segment
+        if not start <= current <= end + 1:
+          lg.info(
+              f"[ResumeRecord]{filename} - segment {start}->{end} is"
+              " inconsistent. Download it again")
+          segment[2] = start
+      return result
+
+    def update(self, num_segment, next_offset):
+      with self.__lock:
+        # A segment is never recorded beyond its end
+        self.segments[num_segment][2] = min(
+            next_offset, self.segments[num_segment][1] + 1)
+        self.__store()
+
+    def store(self):
+      with self.__lock:
+        self.__store()
+
+    def __store(self):
+      tmp_filename = f"{self.filename}.tmp"
+      with open(tmp_filename, 'w') as f:
+        json.dump({
+            "id": self.ms_id,
+            "eTag": self.etag,
+            "size": self.size,
+            "segments": self.segments}, f)
+      os.replace(tmp_filename, self.filename)
+
+    def remove(self):
+      if os.path.exists(self.filename):
+        os.remove(self.filename)
+
+    def remaining_segments(self):
+      """ Return list of (num_segment, start, end) still to be downloaded
+      """
+      return [
+          (i, current, end)
+          for (i, (start, end, current)) in enumerate(self.segments)
+          if current <= end]
+
+    def bytes_done(self):
+      return sum(current - start for (start, end, current) in self.segments)
+
   class RetryStatus:
 
     def __init__(self, max_retry=5):
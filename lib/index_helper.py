@@ -0,0 +1,231 @@
+#  Copyright 2019-2022 Jareth Lomson <jareth.lomson@gmail.com>
+#  This file is part of OneDrive Client Program which is released under MIT License
+#  See file LICENSE for full license details
+import json
+import logging
+import sqlite3
+from threading import RLock
+
+lg = logging.getLogger('odc.index')
+
+
+class DriveIndex:
+  """ Metadata of the items of the drive stored in a SQLite database.
+
+      The index is built by a delta enumeration of the whole drive. The last
+      delta link is stored with the items so that the index is brought up to
+      date incrementally: only items changed since the previous refresh are
+      received.
+      An index is refreshed before its first use and before the first use
+      following a change made by odc (see dirty).
+      Items are stored as received from ms graph. Paths of parents are set
+      when items are read, as a children listing does.
+  """
+
+  def __init__(self, filename, mgc):
+    self.filename = filename
+    self.mgc = mgc
+    self.dirty = True   # Refresh needed before next use
+    self.__lock = RLock()
+    self.__db = sqlite3.connect(filename, check_same_thread=False)
+    self.__db.execute(
+        "CREATE TABLE IF NOT EXISTS items ("
+        " id TEXT PRIMARY KEY, parent_id TEXT, name TEXT,"
+        " is_folder INTEGER, json TEXT)")
+    self.__db.execute(
+        "CREATE INDEX IF NOT EXISTS items_parent ON items (parent_id, name)")
+    self.__db.execute(
+        "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+    self.__db.commit()
+
+  def __get_state(self, key):
+    row = self.__db.execute(
+        "SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return None if row is None else row[0]
+
+  def __set_state(self, key, value):
+    self.__db.execute(
+        "INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+
+  def is_built(self):
+    with self.__lock:
+      return self.__get_state("delta_link") is not None
+
+  def nb_items(self):
+    with self.__lock:
+      return self.__db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+  def refresh(self, full=False):
+    """ Bring the index up to date with the changes of the drive. The index
+        is rebuilt if full is True or if it has never been built.
+        Return True if the index is up to date.
+    """
+    with self.__lock:
+      link = None if full else self.__get_state("delta_link")
+      if link is None:
+        lg.info(f"[DriveIndex]Build index of the drive in {self.filename}")
+        self.__clear()
+      ok = self.__apply_delta(link)
+      if not ok and link is not None:
+        # Delta link has expired or the server requires a full resync
+        lg.info("[DriveIndex]Delta link is rejected. Rebuild index")
+        self.__clear()
+        ok = self.__apply_delta(None)
+      self.dirty = not ok
+      return ok
+
+  def __clear(self):
+    self.__db.execute("DELETE FROM items")
+    self.__db.execute("DELETE FROM state")
+    self.__db.commit()
+
+  def __apply_delta(self, link):
+    (page, next_link, delta_link) = self.mgc.get_ms_response_for_delta(
+        link=link)
+    nb_changes = 0
+    while True:
+      if page is None:
+        return False
+      self.__apply_page(page)
+      # Pages are committed one by one. Applying them again from the
+      # previous delta link gives the same result
+      self.__db.commit()
+      nb_changes += len(page)
+      if next_link is None:
+        break
+      (page, next_link, delta_link) = self.mgc.get_ms_response_for_delta(
+          link=next_link)
+
+    self.__set_state("delta_link", delta_link)
+    self.__db.commit()
+    lg.debug(f"[DriveIndex]{nb_changes} change(s) applied")
+    return True
+
+  def __apply_page(self, page):
+    for item in page:
+      if 'deleted' in item:
+        self.__delete_tree(item['id'])
+        continue
+      if 'root' in item:
+        self.__set_state("root_id", item['id'])
+        parent_id = None
+      else:
+        parent_id = item.get('parentReference', {}).get('id')
+      self.__db.execute(
+          "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)",
+          (item['id'], parent_id, item.get('name'),
+           1 if 'folder' in item else 0, json.dumps(item)))
+
+  def __delete_tree(self, ms_id):
+    self.__db.execute(
+        "WITH RECURSIVE tree(id) AS ("
+        " VALUES (?) UNION SELECT items.id FROM items, tree"
+        " WHERE items.parent_id = tree.id)"
+        " DELETE FROM items WHERE id IN tree", (ms_id,))
+
+  def is_ready(self):
+    """ Return True if the index can be used. It is refreshed if needed """
+    with self.__lock:
+      return self.__is_usable()
+
+  def __is_usable(self):
+    if not self.is_built():
+      return False
+    if self.dirty:
+      return self.refresh()
+    return True
+
+  @staticmethod
+  def __split_path(path):
+    return [p for p in path.split("/") if p != ""]
+
+  def __item_id(self, path):
+    """ Id of the item of path. None if not found """
+    ms_id = self.__get_state("root_id")
+    for name in DriveIndex.__split_path(path):
+      if ms_id is None:
+        break
+      row = self.__db.execute(
+          "SELECT id FROM items WHERE parent_id = ? AND name = ?"
+          " COLLATE NOCASE", (ms_id, name)).fetchone()
+      ms_id = None if row is None else row[0]
+    return ms_id
+
+  @staticmethod
+  def __item_with_parent_path(json_item, parent_path):
+    item = json.loads(json_item)
+    if 'root' in item:
+      item.pop('parentReference', None)
+    else:
+      item['parentReference'] = dict(
+          item.get('parentReference', {}), path=f"/drive/root:{parent_path}")
+    return item
+
+  def get_item(self, path):
+    """ Item of path as returned by ms graph. None if it is unknown or if the
+        index can not be used.
+    """
+    with self.__lock:
+      if not self.__is_usable():
+        return None
+      ms_id = self.__item_id(path)
+      if ms_id is None:
+        return None
+      row = self.__db.execute(
+          "SELECT json FROM items WHERE id = ?", (ms_id,)).fetchone()
+    parts = DriveIndex.__split_path(path)
+    parent_path = "".join(f"/{p}" for p in parts[:-1])
+    return DriveIndex.__item_with_parent_path(row[0], parent_path)
+
+  def get_children(self, folder_path, only_folders=False):
+    """ Children of folder_path as returned by a children listing of ms graph.
+        None if the folder is unknown or if the index can not be used.
+    """
+    with self.__lock:
+      if not self.__is_usable():
+        return None
+      ms_id = self.__item_id(folder_path)
+      if ms_id is None:
+        return None
+      rows = self.__db.execute(
+          "SELECT json FROM items WHERE parent_id = ?"
+          + (" AND is_folder = 1" if only_folders else ""),
+          (ms_id,)).fetchall()
+    parent_path = "".join(
+        f"/{p}" for p in DriveIndex.__split_path(folder_path))
+    return [DriveIndex.__item_with_parent_path(r[0], parent_path)
+            for r in rows]
+
+  def subtree_pages(self, ms_id, folder_path):
+    """ Generate lists of (relative path, item) of the tree of folder ms_id
+        (root if None), folder by folder, as DeltaEnumerator does.
+        Nothing is generated if the index can not be used.
+    """
+    with self.__lock:
+      if not self.__is_usable():
+        return
+      if ms_id is None:
+        ms_id = self.__get_state("root_id")
+    folders_to_be_read = [(ms_id, "")]
+    while len(folders_to_be_read) > 0:
+      (folder_id, relative_path) = folders_to_be_read.pop()
+      with self.__lock:
+        rows = self.__db.execute(
+            "SELECT id, name, is_folder, json FROM items WHERE parent_id = ?",
+            (folder_id,)).fetchall()
+      parent_path = f"{folder_path}/{relative_path}" if (
+          relative_path != "") else folder_path
+      page = []
+      for (child_id, name, is_folder, json_item) in rows:
+        child_path = f"{relative_path}/{name}" if relative_path != "" else name
+        page.append(
+            (child_path,
+             DriveIndex.__item_with_parent_path(json_item, parent_path)))
+        if is_folder:
+          folders_to_be_read.append((child_id, child_path))
+      yield page
+
+  def close(self):
+    with self.__lock:
+      self.__db.commit()
+      self.__db.close()
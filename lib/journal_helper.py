@@ -0,0 +1,98 @@
+#  Copyright 2019-2022 Jareth Lomson <jareth.lomson@gmail.com>
+#  This file is part of OneDrive Client Program which is released under MIT License
+#  See file LICENSE for full license details
+import json
+import logging
+import os
+from threading import Lock
+
+from lib.datetime_helper import utc_dt_from_str_ms_datetime, utc_dt_now
+from lib.file_config_helper import force_permission_file_read_write_owner
+
+lg = logging.getLogger('odc.journal')
+
+
+class UploadJournal:
+  """ Upload sessions of large files stored in a file.
+
+      An upload session can be continued after a crash if the local file has
+      not been changed since the creation of the session.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.__lock = Lock()
+
+  def __load(self):
+    try:
+      with open(self.filename, 'r') as f:
+        return json.load(f)
+    except FileNotFoundError:
+      return {}
+    except (OSError, ValueError) as e:
+      lg.warning(f"[UploadJournal]Error while reading {self.filename} - {e}")
+      return {}
+
+  def __store(self, sessions):
+    tmp_filename = f"{self.filename}.tmp"
+    with open(tmp_filename, 'w') as f:
+      json.dump(sessions, f, indent=2)
+    force_permission_file_read_write_owner(tmp_filename)
+    os.replace(tmp_filename, self.filename)
+
+  @staticmethod
+  def __file_identity(src_file):
+    st = os.stat(src_file)
+    return (os.path.abspath(src_file), st.st_size, st.st_mtime_ns)
+
+  def get_upload_url(self, dst_path, src_file):
+    """ Return upload url of the session started for src_file to dst_path.
+        Return None if no session is found or if it can not be reused.
+    """
+    with self.__lock:
+      sessions = self.__load()
+    if dst_path not in sessions:
+      return None
+    session = sessions[dst_path]
+
+    (abs_path, size, mtime_ns) = UploadJournal.__file_identity(src_file)
+    if (session["src_file"] != abs_path or session["size"] != size
+            or session["mtime_ns"] != mtime_ns):
+      lg.info(
+          f"[UploadJournal]{src_file} has changed since the upload session"
+          " was created. Session is ignored")
+      self.remove(dst_path)
+      return None
+
+    if session["expiration"] is not None:
+      try:
+        expired = utc_dt_from_str_ms_datetime(
+            session["expiration"]) <= utc_dt_now()
+      except ValueError:
+        expired = False  # Server will tell if session no longer exists
+      if expired:
+        lg.info(f"[UploadJournal]Upload session of {dst_path} has expired")
+        self.remove(dst_path)
+        return None
+
+    return session["upload_url"]
+
+  def add(self, dst_path, src_file, upload_url, expiration=None):
+    (abs_path, size, mtime_ns) = UploadJournal.__file_identity(src_file)
+    with self.__lock:
+      sessions = self.__load()
+      sessions[dst_path] = {
+          "upload_url": upload_url,
+          "src_file": abs_path,
+          "size": size,
+          "mtime_ns": mtime_ns,
+          "expiration": expiration
+      }
+      self.__store(sessions)
+
+  def remove(self, dst_path):
+    with self.__lock:
+      sessions = self.__load()
+      if dst_path in sessions:
+        sessions.pop(dst_path)
+        self.__store(sessions)
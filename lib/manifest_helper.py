@@ -0,0 +1,113 @@
+#  Copyright 2019-2022 Jareth Lomson <jareth.lomson@gmail.com>
+#  This file is part of OneDrive Client Program which is released under MIT License
+#  See file LICENSE for full license details
+import logging
+
+from lib.delta_helper import DeltaEnumerator, DeltaError
+from lib.graph_helper import MsGraphClient
+from lib.msobject_info import ObjectInfoFactory, MsFileInfo, MsFolderInfo
+
+lg = logging.getLogger('odc.manifest')
+
+
+class RemoteManifest:
+  """ Flat view of the tree of a remote folder.
+
+      Files and folders are keyed by their path relative to the folder
+      ("a/b/c.txt"). The tree is enumerated once with a delta query scoped to
+      the folder. If the drive does not support it, folders are listed one by
+      one.
+  """
+
+  def __init__(self, mgc: MsGraphClient, folder_info: MsFolderInfo):
+    self.mgc = mgc
+    self.root_path = folder_info.path
+    self.root_id = folder_info.ms_id
+    self.root_is_drive_root = folder_info.is_root
+    self.__objects = {"": folder_info}
+    self.nb_requests = 0
+
+  def build(self):
+    if not self.__build_from_delta():
+      lg.info(
+          f"[RemoteManifest]Delta is not available for '{self.root_path}'"
+          " - list folders one by one")
+      self.__build_from_children()
+    lg.debug(
+        f"[RemoteManifest]{self.root_path} - {len(self.__objects)} objects"
+        f" - {self.nb_requests} request(s)")
+    return self
+
+  def __build_from_delta(self):
+    enumerator = DeltaEnumerator(
+        self.mgc, None if self.root_is_drive_root else self.root_id,
+        self.root_path)
+    try:
+      for page in enumerator.pages():
+        for (relative_path, item) in page:
+          self.__add_item(relative_path, item)
+    except DeltaError:
+      self.__objects = {"": self.__objects[""]}
+      return False
+    finally:
+      self.nb_requests += enumerator.nb_requests
+    return True
+
+  def __build_from_children(self):
+    folders_to_be_listed = [""]
+    while len(folders_to_be_listed) > 0:
+      relative_folder_path = folders_to_be_listed.pop()
+      (page, next_link) = self.mgc.get_ms_response_for_children_folder_path(
+          self.absolute_path(relative_folder_path))
+      self.nb_requests += 1
+      while page is not None:
+        for item in page:
+          relative_path = (
+              f"{relative_folder_path}/{item['name']}"
+              if relative_folder_path != "" else item['name'])
+          self.__add_item(relative_path, item)
+          if 'folder' in item:
+            folders_to_be_listed.append(relative_path)
+        if next_link is None:
+          break
+        (page, next_link) = (
+            self.mgc.get_ms_response_for_children_folder_path_from_link(
+                next_link))
+        self.nb_requests += 1
+
+  def __add_item(self, relative_path, item):
+    if 'folder' in item:
+      obj = ObjectInfoFactory.MsFolderFromMgcResponse(
+          self.mgc, item, no_warn_if_no_parent=True,
+          no_update_of_global_dict=True)
+    elif 'file' in item:
+      obj = ObjectInfoFactory.MsFileInfoFromMgcResponse(
+          self.mgc, item, no_warn_if_no_parent=True,
+          no_update_of_global_dict=True)
+    else:
+      return    # Package (OneNote...) or other kind of item
+    self.__objects[relative_path] = obj
+
+  def absolute_path(self, relative_path):
+    return (
+        self.root_path if relative_path == ""
+        else f"{self.root_path}/{relative_path}")
+
+  def add(self, relative_path, obj):
+    self.__objects[relative_path] = obj
+
+  def get(self, relative_path):
+    return self.__objects.get(relative_path)
+
+  def get_file(self, relative_path):
+    obj = self.__objects.get(relative_path)
+    return obj if isinstance(obj, MsFileInfo) else None
+
+  def is_file(self, relative_path):
+    return isinstance(self.__objects.get(relative_path), MsFileInfo)
+
+  def is_folder(self, relative_path):
+    return isinstance(self.__objects.get(relative_path), MsFolderInfo)
+
+  def __len__(self):
+    return len(self.__objects)
@@ -6,18 +6,26 @@ import logging
 import math
 import os
 import sys
+import time
+from bisect import bisect_left
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from beartype import beartype
-from lib._typing import Optional, Tuple
+from lib._typing import Optional, Tuple, Union
+from lib.delta_helper import DeltaEnumerator, DeltaError
 from lib.graph_helper import MsGraphClient
 from lib.datetime_helper import utc_dt_from_str_ms_datetime, utc_dt_now
 from lib.strpathutil import StrPathUtil
-from threading import Lock
+from threading import Lock, RLock
 
 lg = logging.getLogger('odc.msobject')
 
 
 class MsObject(ABC):
+  # Trees can hold millions of objects: no __dict__ per object
+  __slots__ = ("ms_id", "__size", "__parent", "__name", "__parent_path",
+               "__cdt", "__lmdt", "is_root", "__path")
 
   @beartype
   def __init__(
@@ -27,35 +35,68 @@ class MsObject(ABC):
           parent_path: str,
           ms_id: str,
           size: int,
-          lmdt: datetime.datetime,
-          cdt: datetime.datetime,
+          lmdt: Union[datetime.datetime, str],
+          cdt: Union[datetime.datetime, str],
           is_root: bool = False):
+    """ lmdt and cdt can be given as strings from ms graph. They are parsed
+        at first use.
+    """
     # Parent stat must not been updated if parent has just been initiated through mgc_response:
     #   - mgc_response contains child count, size but not all children
     self.ms_id = ms_id  # id is a keyword in python
     self.__size = size
     self.__parent = parent
-    self.__name = name
-    self.__parent_path = parent_path
-    self.creation_datetime = cdt
-    self.last_modified_datetime = lmdt
+    self.__name = sys.intern(name)
+    self.__parent_path = (
+        sys.intern(parent_path) if parent_path is not None else None)
+    self.__cdt = cdt
+    self.__lmdt = lmdt
     self.is_root = is_root  # used to compute path
+    self.__path = None  # Computed at first use
+
+  @property
+  def creation_datetime(self):
+    if isinstance(self.__cdt, str):
+      self.__cdt = utc_dt_from_str_ms_datetime(self.__cdt)
+    return self.__cdt
+
+  @creation_datetime.setter
+  def creation_datetime(self, cdt):
+    self.__cdt = cdt
+
+  @property
+  def last_modified_datetime(self):
+    if isinstance(self.__lmdt, str):
+      self.__lmdt = utc_dt_from_str_ms_datetime(self.__lmdt)
+    return self.__lmdt
+
+  @last_modified_datetime.setter
+  def last_modified_datetime(self, lmdt):
+    self.__lmdt = lmdt
+
+  def _copy_datetimes(self, reference: "MsObject"):
+    """ Copy datetimes of reference without parsing them """
+    self.__cdt = reference.__cdt
+    self.__lmdt = reference.__lmdt
 
   @property
   def path(self):
-    if self.__parent_path is None and self.parent is not None:
-      # No parent path where parent exists.
-      # Could be possible when new object has been detected without being
-      # created through the shell
-      if lg.level >= logging.DEBUG:
-        lg.debug(f"path is invoked for {self.__name} whereas parent path"
-                 f" does not exists. Create it")
+    if self.__path is not None:
+      return self.__path
+    if self.parent is not None:
+      # Parent path is taken from parent which may have been renamed or
+      # moved since this object has been created
       self.__parent_path = self.parent.path
     elif (lg.level >= logging.DEBUG
           and self.__parent_path is None and self.parent is None):
       lg.debug(f"path is invoked for {self.__name} whereas parent"
                f"is None. An exception will be probably raised")
-    return "" if self.is_root else f"{self.__parent_path}/{self.__name}"
+    self.__path = "" if self.is_root else f"{self.__parent_path}/{self.__name}"
+    return self.__path
+
+  def _invalidate_path(self):
+    """ Path will be computed again at next use """
+    self.__path = None
 
   @property
   def parent_path(self):
@@ -75,8 +116,13 @@ class MsObject(ABC):
 
   def set_name(self, new_name):
     if self.name != new_name:
+      if self.parent is not None:
+        self.parent._unindex_subtree(self)
       self._change_name_in_parent(new_name)
-      self.__name = new_name
+      self.__name = sys.intern(new_name)
+      self._invalidate_path()
+      if self.parent is not None:
+        self.parent._index_subtree(self)
 
   @property
   def size(self):
@@ -92,6 +138,7 @@ class MsObject(ABC):
   def update_parent(self, new_parent):
     self.__parent = new_parent
     self.__parent_path = self.parent.path
+    self._invalidate_path()
 
   @property
   def __isabstractmethod__(self):
@@ -103,12 +150,11 @@ class MsObject(ABC):
       return
     if lmdt is None:
       lmdt = utc_dt_now()
-    self.parent.child_count -= 1
+    self.parent._roll_up(-self.size, lmdt, -1)
 
-    current_parent = self.parent
+    current_parent = self.parent.parent
     while current_parent is not None:
-      current_parent.__size -= self.size
-      current_parent.last_modified_datetime = lmdt
+      current_parent._roll_up(-self.size, lmdt)
       current_parent = current_parent.parent
 
     self.parent.remove_info_for_child(self)
@@ -121,11 +167,10 @@ class MsObject(ABC):
       return
     if lmdt is None:
       lmdt = utc_dt_now()
-    new_parent.child_count += 1
-    current_parent = new_parent
+    new_parent._roll_up(self.__size, lmdt, 1)
+    current_parent = new_parent.parent
     while current_parent is not None:
-      current_parent.__size += self.__size
-      current_parent.last_modified_datetime = lmdt
+      current_parent._roll_up(self.__size, lmdt)
       current_parent = current_parent.parent
     new_parent.add_object_info(self)
 
@@ -140,7 +185,8 @@ class MsObject(ABC):
   @beartype
   def rename(self, new_name: str):
     self.update_parent_before_removal()
-    self.__name = new_name
+    self.__name = sys.intern(new_name)
+    self._invalidate_path()
     self.update_parent_after_arrival(self.parent)
 
   @staticmethod
@@ -188,22 +234,139 @@ class MsObject(ABC):
         # remove the last folder name which is the start text
         folder_names = folder_names[:-1]
 
-    search_folder = root_fi
-    found = True
-    for f in folder_names:
-      if search_folder.is_direct_child_folder(f, True):
-        search_folder = search_folder.get_direct_child_folder(f, True)
-      else:
-        found = False
-        break
-
-    if found:
+    if len(folder_names) == 0:
+      return (root_fi, start_text)
+    search_folder = root_fi.get_child_folder(os.sep.join(folder_names), True)
+    if search_folder is not None:
       return (search_folder, start_text)
     else:
       return (None, None)
 
 
+class MsChildren:
+  """ Children of one kind (files or folders) of a folder, indexed by name
+      and kept in order of arrival.
+      An entry is the info of the child or, while this info is not built,
+      the item of the child received from ms graph.
+  """
+  __slots__ = ("__entries", "__nb_raw", "__sorted_names")
+
+  def __init__(self):
+    self.__entries = {}   # name -> info or item of ms graph
+    self.__nb_raw = 0
+    self.__sorted_names = None  # Computed by names() at first use
+
+  def __len__(self):
+    return len(self.__entries)
+
+  def __contains__(self, name):
+    return name in self.__entries
+
+  def has_raw(self):
+    return self.__nb_raw > 0
+
+  def get_built(self, name):
+    entry = self.__entries.get(name)
+    return None if isinstance(entry, dict) else entry
+
+  def get_raw(self, name):
+    entry = self.__entries.get(name)
+    return entry if isinstance(entry, dict) else None
+
+  def add(self, obj: MsObject):
+    """ Add the info of a child. It replaces the item of the child if any.
+        Return False if an info is already known with this name.
+    """
+    entry = self.__entries.get(obj.name)
+    if entry is None:
+      self.__sorted_names = None
+    elif isinstance(entry, dict):
+      self.__nb_raw -= 1
+    else:
+      return False
+    self.__entries[obj.name] = obj
+    return True
+
+  def add_raw(self, name, item):
+    """ Add or replace the item of a child whose info is not built. Return
+        False if an info is already known with this name.
+    """
+    entry = self.__entries.get(name)
+    if entry is None:
+      self.__sorted_names = None
+      self.__nb_raw += 1
+    elif not isinstance(entry, dict):
+      return False
+    self.__entries[name] = item
+    return True
+
+  def pop(self, name):
+    """ Remove and return the entry of name. None if not found """
+    entry = self.__entries.pop(name, None)
+    if entry is not None:
+      self.__sorted_names = None
+      if isinstance(entry, dict):
+        self.__nb_raw -= 1
+    return entry
+
+  def rename(self, name, new_name):
+    self.__entries[new_name] = self.__entries.pop(name)
+    self.__sorted_names = None
+
+  def names(self, prefix=""):
+    """ Sorted names starting with prefix """
+    if self.__sorted_names is None:
+      self.__sorted_names = sorted(self.__entries)
+    result = []
+    for i in range(
+            bisect_left(self.__sorted_names, prefix), len(self.__sorted_names)):
+      if not self.__sorted_names[i].startswith(prefix):
+        break
+      result.append(self.__sorted_names[i])
+    return result
+
+  def built(self):
+    return [e for e in self.__entries.values() if not isinstance(e, dict)]
+
+  def raw_items(self):
+    return [e for e in self.__entries.values() if isinstance(e, dict)]
+
+  def pop_raw_items(self):
+    """ Remove and return the items of children whose info is not built """
+    result = self.raw_items()
+    if len(result) > 0:
+      self.__entries = {
+          name: e for (name, e) in self.__entries.items()
+          if not isinstance(e, dict)}
+      self.__nb_raw = 0
+      self.__sorted_names = None
+    return result
+
+
 class MsFolderInfo(MsObject):
+  """ Info of a folder and of its children.
+
+      Trees are shared by the commands of the shell, the delta thread and
+      the workers of listings. The lock of a folder protects its children,
+      their retrieval status and its size. It is held for short steps only:
+      infos of other folders are updated out of it, except those of
+      subfolders, so that locks are always taken from top to bottom.
+      Lookups of one name do not lock the folder: a dict lookup is atomic.
+  """
+  __slots__ = ("__mgc", "__children_file", "__children_folder",
+               "next_link_children", "child_count", "__path_index",
+               "__children_files_retrieval_status",
+               "__children_folders_retrieval_status",
+               "children_retrieval_time", "__lock")
+
+  # Number of folders listed simultaneously by a concurrent retrieval
+  NB_CONCURRENT_LISTINGS = 8
+  # Minimum depth of a retrieval using delta. Delta enumerates the whole tree
+  # whatever the depth: a few levels are cheaper to list folder by folder
+  DELTA_MIN_DEPTH = 5
+
+  # Lock of path indexes. No lock of a folder is taken while it is held
+  __lock_index = Lock()
 
   @beartype
   def __init__(
@@ -224,46 +387,284 @@ class MsFolderInfo(MsObject):
     """
     super().__init__(parent, name, parent_path, id, size, lmdt, cdt, is_root)
     self.__mgc = mgc
-    self.children_file = []
-    self.children_folder = []
-    self.__dict_children_file = {}
-    self.__dict_children_folder = {}
+    self.__lock = RLock()
+    # Infos of listed children are built when children are looked up or
+    # iterated
+    self.__children_file = MsChildren()
+    self.__children_folder = MsChildren()
     self.next_link_children = None
 
     self.child_count = child_count
 
+    # Full path -> object of all objects of the tree linked to their parent.
+    # Shared by all folders of the tree. None if the folder is not linked
+    # to a root folder
+    self.__path_index = {"": self} if is_root else None
+
     self.__children_files_retrieval_status = None    # None,"partial" or "all"
     self.__children_folders_retrieval_status = None  # None, "partial" or "all"
+    # time.monotonic() value at the end of the last complete listing
+    self.children_retrieval_time = None
+
+  def __children(self, is_folder):
+    return self.__children_folder if is_folder else self.__children_file
+
+  def __built_children(self, only_folders=False):
+    """ Copy of the list of built infos of children """
+    with self.__lock:
+      return self.__children_folder.built() + (
+          [] if only_folders else self.__children_file.built())
+
+  def __children_list(self, is_folder):
+    DictMsObject.touch(self)
+    with self.__lock:
+      names = [c['name'] for c in self.__children(is_folder).raw_items()]
+    for name in names:
+      self._build_child(name, is_folder)
+    with self.__lock:
+      return self.__children(is_folder).built()
 
-    self.__add_default_folder_info()
+  @property
+  def children_file(self):
+    return self.__children_list(False)
 
-  def update_parent(self, new_parent):
-    super().update_parent(new_parent)
-    self.__dict_children_folder[".."] = self.parent
+  @property
+  def children_folder(self):
+    return self.__children_list(True)
+
+  def children_names(self, prefix="", only_folders=False):
+    """ Sorted list of (name, is_folder) of retrieved children whose name
+        starts with prefix. No info is built.
+    """
+    DictMsObject.touch(self)
+    with self.__lock:
+      result = [(name, True) for name in self.__children_folder.names(prefix)]
+      if not only_folders:
+        result.extend(
+            (name, False) for name in self.__children_file.names(prefix))
+    if not only_folders:
+      result.sort()
+    return result
+
+  def _roll_up(self, size, lmdt, nb_children=0):
+    """ Take into account a change of size of the tree below the folder """
+    with self.__lock:
+      self.set_size(self.size + size)
+      self.last_modified_datetime = lmdt
+      if nb_children != 0 and self.child_count is not None:
+        self.child_count += nb_children
+
+  def __add_raw_children(
+          self, ms_response, only_folders, with_folders=True,
+          discard_raw=False):
+    """ Keep children of a listing without building their info. Infos
+        already built are updated. Return names of new subfolders.
+        discard_raw   children whose info is not built are replaced by those
+                      of the listing
+    """
+    new_folder_names = []
+    built_children = []
+    with self.__lock:
+      if discard_raw:
+        self.__discard_raw_children(only_folders)
+      for c in ms_response:
+        isFolder = 'folder' in c
+        if isFolder and not with_folders or not isFolder and only_folders:
+          continue
+        name = c['name']
+        children = self.__children(isFolder)
+        if isFolder and name not in children:
+          new_folder_names.append(name)
+        if children.add_raw(name, c):
+          DictMsObject.add_raw(c['id'], self, name, isFolder)
+        else:
+          built_children.append(c)
+    # Updates may lock other folders
+    for c in built_children:
+      if 'folder' in c:
+        ObjectInfoFactory.MsFolderFromMgcResponse(self.__mgc, c, self)
+      else:
+        ObjectInfoFactory.MsFileInfoFromMgcResponse(self.__mgc, c, self)
+    return new_folder_names
+
+  def _build_child(self, name, is_folder):
+    """ Build info of a child kept by __add_raw_children. Return the info
+        of the child. None if there is no such child.
+    """
+    with self.__lock:
+      children = self.__children(is_folder)
+      c = children.get_raw(name)
+      if c is None:   # Info may have been built by another thread
+        return children.get_built(name)
+      # Info replaces the item at the same place. It is registered before
+      # the lock is released so that the item or the registered info is
+      # seen by other threads
+      if is_folder:
+        result = ObjectInfoFactory.MsFolderFromMgcResponse(
+            self.__mgc, c, self, no_update_of_global_dict=True)
+      else:
+        result = ObjectInfoFactory.MsFileInfoFromMgcResponse(
+            self.__mgc, c, self, no_update_of_global_dict=True)
+      known_object = DictMsObject.register(result)
+    if known_object is not result:
+      # Object has been moved here and is known by its previous parent
+      ObjectInfoFactory.update_object_info(known_object, result)
+    return result
+
+  def __discard_raw_children(self, only_folders):
+    with self.__lock:
+      for is_folder in ((True, ) if only_folders else (True, False)):
+        for c in self.__children(is_folder).pop_raw_items():
+          DictMsObject.discard_raw(c['id'], self)
+
+  def forget_children(self):
+    """ Forget the tree below the folder. Its children will be retrieved
+        again when needed. Return the number of forgotten objects.
+    """
+    for child in self.__built_children():
+      self._unindex_subtree(child)
+    nb_objects = 0
+    folders = [self]
+    while len(folders) > 0:
+      folder = folders.pop()
+      with folder.__lock:
+        # Children are detached from the folder: other threads do not see
+        # them anymore
+        all_children = (folder.__children_folder, folder.__children_file)
+        folder.__children_file = MsChildren()
+        folder.__children_folder = MsChildren()
+        folder.next_link_children = None
+        folder.__children_files_retrieval_status = None
+        folder.__children_folders_retrieval_status = None
+        folder.children_retrieval_time = None
+      for children in all_children:
+        for c in children.pop_raw_items():
+          DictMsObject.discard_raw(c['id'], folder)
+          nb_objects += 1
+        for child in children.built():
+          if DictMsObject.get_built(child.ms_id) is child:
+            DictMsObject.remove(child.ms_id)
+          nb_objects += 1
+      folders.extend(all_children[0].built())
+    return nb_objects
+
+  def __subtree(self, child: MsObject):
+    """ Objects of the tree of child, child included """
+    result = [child]
+    folders = [child] if isinstance(child, MsFolderInfo) else []
+    while len(folders) > 0:
+      folder = folders.pop()
+      children = folder.__built_children()
+      result.extend(children)
+      folders.extend(c for c in children if isinstance(c, MsFolderInfo))
+    return result
+
+  def _invalidate_path(self):
+    # Paths of all objects of the tree depend on path of this folder
+    for obj in self.__subtree(self):
+      MsObject._invalidate_path(obj)
+
+  def __has_child(self, child: MsObject):
+    return self.__children(
+        isinstance(child, MsFolderInfo)).get_built(child.name) is child
+
+  def _index_subtree(self, child: MsObject):
+    """ Add child and its tree to the path index if child is linked """
+    index = self.__path_index
+    if index is None or not self.__has_child(child):
+      return
+    objects = self.__subtree(child)
+    with MsFolderInfo.__lock_index:
+      for obj in objects:
+        index[obj.path] = obj
+        if isinstance(obj, MsFolderInfo):
+          obj.__path_index = index
+
+  def _unindex_subtree(self, child: MsObject):
+    """ Remove child and its tree from the path index """
+    index = self.__path_index
+    if index is None:
+      return
+    objects = self.__subtree(child)
+    with MsFolderInfo.__lock_index:
+      for obj in objects:
+        if index.get(obj.path) is obj:
+          index.pop(obj.path)
+        if isinstance(obj, MsFolderInfo):
+          obj.__path_index = None
+
+  def __get_indexed_child(self, path_parts, object_type):
+    """ Child of relative path path_parts from the path index. None if it
+        is not indexed.
+    """
+    if self.__path_index is None or "." in path_parts or ".." in path_parts:
+      return None
+    result = self.__path_index.get(f"{self.path}/{'/'.join(path_parts)}")
+    if not isinstance(result, object_type):
+      return None
+    # Child may have been removed by another thread while it was indexed
+    return result if (
+        result.parent is not None and result.parent.__has_child(result)
+    ) else None
 
   def _change_name_in_parent(self, new_name):
     if self.parent is not None:
-      if self.name in self.parent.__dict_children_folder:
-        self.parent.__dict_children_folder.pop(self.name)
-        self.parent.__dict_children_folder[new_name] = self
+      self.parent._rename_child(self, new_name)
+
+  def _rename_child(self, child: MsObject, new_name):
+    with self.__lock:
+      if self.__has_child(child):
+        self.__children(isinstance(child, MsFolderInfo)).rename(
+            child.name, new_name)
 
   @beartype
   def remove_info_for_child(self, child: MsObject):
-    if isinstance(child, MsFolderInfo):
-      self.children_folder.remove(child)
-      self.__dict_children_folder.pop(child.name)
-    else:  # isinstance(child, MsFileInfo)
-      self.children_file.remove(child)
-      self.__dict_children_file.pop(child.name)
+    self._unindex_subtree(child)
+    with self.__lock:
+      if self.__has_child(child):
+        self.__children(isinstance(child, MsFolderInfo)).pop(child.name)
+
+  def __set_retrieval_status(self, only_folders):
+    """ Set retrieval status of children after a listing """
+    with self.__lock:
+      status = "partial" if self.next_link_children is not None else "all"
+      if not only_folders:
+        self.__children_files_retrieval_status = status
+      self.__children_folders_retrieval_status = status
+      if self.next_link_children is None:
+        self.children_retrieval_time = time.monotonic()
+    DictMsObject.touch(self)
 
   def retrieve_children_info(
           self,
           only_folders=False,
           recursive=False,
-          depth=999):
+          depth=999,
+          use_delta=False,
+          nb_workers=1):
+    """ Retrieve children of the folder, and of its subfolders up to depth
+        - 1 levels below it if recursive.
+        use_delta   the whole tree is enumerated with delta if possible and
+                    depth is at least DELTA_MIN_DEPTH
+        nb_workers  number of folders listed simultaneously (recursive only)
+    """
     lg.debug(
         f"[retrieve_children_info] {self.path} - only_folders = {only_folders} - depth = {depth}")
 
+    if use_delta and recursive and depth >= MsFolderInfo.DELTA_MIN_DEPTH:
+      try:
+        self.__retrieve_children_info_from_delta(only_folders, depth)
+        return
+      except DeltaError as e:
+        lg.info(
+            f"[retrieve_children_info] {self.path} - {e}"
+            " - list folders one by one")
+
+    if nb_workers > 1 and recursive and depth > 1:
+      self.__retrieve_children_info_concurrently(
+          only_folders, depth, nb_workers)
+      return
+
     if depth > 0 and (
         only_folders and not self.folders_retrieval_has_started()
         or not self.files_retrieval_has_started() or not self.folders_retrieval_has_started()
@@ -277,29 +678,134 @@ class MsFolderInfo(MsObject):
 
       self.next_link_children = next_link
 
-      for c in ms_response:
-        isFolder = 'folder' in c
-        if isFolder and not self.folders_retrieval_has_started():
-          fi = ObjectInfoFactory.MsFolderFromMgcResponse(self.__mgc, c, self)
-          self.__add_folder_info_if_necessary(fi)
-          if recursive:
-            fi.retrieve_children_info(
-                only_folders=only_folders,
-                recursive=recursive,
-                depth=depth - 1)
-
-        elif not only_folders and not isFolder:
-          fi = ObjectInfoFactory.MsFileInfoFromMgcResponse(self.__mgc, c, self)
-          self.__add_file_info_if_necessary(fi)
-        # else:   - isFolder and folder already retrieved
+      new_folder_names = self.__add_raw_children(
+          ms_response, only_folders,
+          with_folders=not self.folders_retrieval_has_started())
+      if recursive:
+        for name in new_folder_names:
+          self.get_direct_child_folder(name).retrieve_children_info(
+              only_folders=only_folders,
+              recursive=recursive,
+              depth=depth - 1)
 
       lg.debug(
           f"[retrieve_children_info] {self.path} - setting retrieval status")
 
-      if not only_folders:
-        self.__children_files_retrieval_status = "partial" if self.next_link_children is not None else "all"
+      self.__set_retrieval_status(only_folders)
 
-      self.__children_folders_retrieval_status = "partial" if self.next_link_children is not None else "all"
+  def __retrieve_children_info_from_delta(self, only_folders, depth):
+    """ Retrieve the whole tree with a delta enumeration. Folders up to
+        depth - 1 levels below this one have their children retrieved.
+    """
+    enumerator = DeltaEnumerator(
+        self.__mgc, None if self.is_root else self.ms_id, self.path)
+    folders = {"": self}   # relative path -> folder info
+    for page in enumerator.pages():
+      for (relative_path, c) in page:
+        (parent_path, _, name) = relative_path.rpartition("/")
+        parent = folders.get(parent_path)
+        if parent is None:
+          continue   # Below maximum depth
+        isFolder = 'folder' in c
+        if isFolder:
+          ObjectInfoFactory.MsFolderFromMgcResponse(self.__mgc, c, parent)
+          if relative_path.count("/") + 1 < depth:
+            # Keep folder info already known by parent if any
+            folders[relative_path] = parent.get_direct_child_folder(name)
+        elif not only_folders and 'file' in c:
+          parent.__add_raw_children((c, ), only_folders)
+
+    for folder in folders.values():
+      folder.next_link_children = None
+      folder.__set_retrieval_status(only_folders)
+    lg.debug(
+        f"[retrieve_children_info] {self.path} - {len(folders)} folders"
+        f" retrieved with {enumerator.nb_requests} request(s)")
+
+  def update_children_from_ms_response(self, ms_response, only_folders=False):
+    """ Set children of the folder from a complete listing.
+        Infos of children which are already built are updated in place.
+        Children which are not listed anymore are removed.
+    """
+    listed = {
+        c['id']: c for c in ms_response
+        if not only_folders or 'folder' in c}
+
+    for child in self.__built_children(only_folders):
+      c = listed.pop(child.ms_id, None)
+      if c is None:
+        self.remove_info_for_child(child)
+        if DictMsObject.get_built(child.ms_id) is child:
+          DictMsObject.remove(child.ms_id)
+      elif 'folder' in c and isinstance(child, MsFolderInfo):
+        ObjectInfoFactory.UpdateMsFolderInfo(
+            child, ObjectInfoFactory.MsFolderFromMgcResponse(
+                self.__mgc, c, no_warn_if_no_parent=True,
+                no_update_of_global_dict=True))
+      elif 'folder' not in c and isinstance(child, MsFileInfo):
+        ObjectInfoFactory.UpdateMsFileInfo(
+            child, ObjectInfoFactory.MsFileInfoFromMgcResponse(
+                self.__mgc, c, no_warn_if_no_parent=True,
+                no_update_of_global_dict=True))
+
+    # Children whose info is not built are taken from the listing. Objects
+    # built elsewhere have been moved: delta processing will handle them
+    self.__add_raw_children(
+        [c for c in listed.values() if DictMsObject.get_built(c['id']) is None],
+        only_folders, discard_raw=True)
+
+    self.next_link_children = None
+    self.__set_retrieval_status(only_folders)
+
+  def __needs_children_retrieval(self, only_folders):
+    return (only_folders and not self.folders_retrieval_has_started()
+            or not self.files_retrieval_has_started()
+            or not self.folders_retrieval_has_started())
+
+  def __retrieve_children_info_concurrently(
+          self, only_folders, depth, nb_workers):
+    """ Retrieve the tree by listing several folders at the same time.
+        Each worker lists a folder and adds its children to the tree.
+        Folders already listed are not listed again but their subfolders
+        are looked at.
+    """
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+      pending = {}   # future -> (folder, depth)
+
+      def submit_listings(folder, folder_depth):
+        # Submit listings of folder and of its known subfolders which need
+        # one, down to folder_depth levels
+        folders = [(folder, folder_depth)]
+        while len(folders) > 0:
+          (fi, fi_depth) = folders.pop()
+          if fi.__needs_children_retrieval(only_folders):
+            pending[executor.submit(fi.__list_children, only_folders)] = (
+                fi, fi_depth)
+          elif fi_depth > 1:
+            folders.extend((c, fi_depth - 1) for c in fi.children_folder)
+
+      submit_listings(self, depth)
+      while len(pending) > 0:
+        (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          (folder, folder_depth) = pending.pop(future)
+          future.result()
+          if folder_depth > 1:
+            for fi in folder.children_folder:
+              submit_listings(fi, folder_depth - 1)
+
+  def __list_children(self, only_folders):
+    """ Add children of a complete listing of the folder """
+    ms_response = self.__mgc.get_all_children_of_folder_path(
+        self.path, only_folders)
+    if ms_response is None:  # Can occurs if folder has change name
+      return
+    self.__add_raw_children(
+        ms_response, only_folders,
+        with_folders=not self.folders_retrieval_has_started())
+
+    self.next_link_children = None
+    self.__set_retrieval_status(only_folders)
 
   def retrieve_children_info_next(
           self,
@@ -318,30 +824,18 @@ class MsFolderInfo(MsObject):
           self.next_link_children, only_folders)
       self.next_link_children = next_link
 
-      for c in ms_response:
-        isFolder = 'folder' in c
-        if isFolder:
-          fi = ObjectInfoFactory.MsFolderFromMgcResponse(self.__mgc, c, self)
-          self.__add_folder_info_if_necessary(fi)
-          if recursive:
-            fi.retrieve_children_info(
-                only_folders=only_folders,
-                recursive=recursive,
-                depth=depth - 1)
-
-        elif not only_folders and not isFolder:
-          fi = ObjectInfoFactory.MsFileInfoFromMgcResponse(self.__mgc, c)
-          self.__add_file_info_if_necessary(fi)
-        else:
-          lg.info("retrieve_children_info : UNKNOWN RESPONSE")
+      new_folder_names = self.__add_raw_children(ms_response, only_folders)
+      if recursive:
+        for name in new_folder_names:
+          self.get_direct_child_folder(name).retrieve_children_info(
+              only_folders=only_folders,
+              recursive=recursive,
+              depth=depth - 1)
 
       lg.debug(
           f"[retrieve_children_info_from_link] {self.next_link_children} - setting retrieval status")
 
-      if not only_folders:
-        self.__children_files_retrieval_status = "partial" if self.next_link_children is not None else "all"
-
-      self.__children_folders_retrieval_status = "partial" if self.next_link_children is not None else "all"
+      self.__set_retrieval_status(only_folders)
 
   def create_empty_subfolder(self, folder_name):
     folder_json = self.__mgc.create_folder(self.path, folder_name)
@@ -354,26 +848,29 @@ class MsFolderInfo(MsObject):
       self.__add_folder_info_if_necessary(new_folder_info)
       new_folder_info.update_parent_after_arrival(
           self, new_folder_info.last_modified_datetime)
-      if self.child_count is not None:
-        self.child_count += 1
+      with self.__lock:
+        if self.child_count is not None:
+          self.child_count += 1
       return new_folder_info
     else:
       return None
 
   def __add_folder_info_if_necessary(self, folder_info):
-    if folder_info.name not in self.__dict_children_folder:
-      self.children_folder.append(folder_info)
-      self.__dict_children_folder[folder_info.name] = folder_info
-
-  def __add_default_folder_info(self):
-    # add subfolder "." and ".."
-    self.__dict_children_folder["."] = self
-    self.__dict_children_folder[".."] = self.parent
+    self.__add_info_if_necessary(folder_info, True)
 
   def __add_file_info_if_necessary(self, file_info):
-    if file_info.name not in self.__dict_children_file:
-      self.children_file.append(file_info)
-      self.__dict_children_file[file_info.name] = file_info
+    self.__add_info_if_necessary(file_info, False)
+
+  def __add_info_if_necessary(self, info, is_folder):
+    # A built info replaces the listed item of the child
+    with self.__lock:
+      children = self.__children(is_folder)
+      raw_child = children.get_raw(info.name)
+      if not children.add(info):
+        return
+      if raw_child is not None:
+        DictMsObject.discard_raw(raw_child['id'], self)
+    self._index_subtree(info)
 
   def add_object_info(self, object_info: MsObject):
     if isinstance(object_info, MsFolderInfo):
@@ -387,7 +884,13 @@ class MsFolderInfo(MsObject):
           force_children_retrieval=False):
     if force_children_retrieval and not self.folders_retrieval_has_started():
       self.retrieve_children_info(only_folders=True)
-    return self.__dict_children_folder[folder_name] if folder_name in self.__dict_children_folder else None
+    DictMsObject.touch(self)
+    if folder_name == ".":
+      return self
+    if folder_name == "..":
+      return self.parent
+    return (self.__children_folder.get_built(folder_name)
+            or self._build_child(folder_name, True))
 
   def get_child_folder(
           self,
@@ -396,6 +899,9 @@ class MsFolderInfo(MsObject):
     path_parts = relative_folder_path.split(os.sep)
     if path_parts[-1] == "":      # folder_path ends with a "/"
       path_parts = path_parts[:-1]
+    indexed_folder = self.__get_indexed_child(path_parts, MsFolderInfo)
+    if indexed_folder is not None:
+      return indexed_folder
     search_folder = self
     for f in path_parts:
       if search_folder.is_direct_child_folder(f, force_children_retrieval):
@@ -408,13 +914,18 @@ class MsFolderInfo(MsObject):
   def get_direct_child_file(self, file_name, force_children_retrieval=False):
     if force_children_retrieval and not self.folders_retrieval_has_started():
       self.retrieve_children_info(only_folders=False)
-    return self.__dict_children_file[file_name] if file_name in self.__dict_children_file else None
+    DictMsObject.touch(self)
+    return (self.__children_file.get_built(file_name)
+            or self._build_child(file_name, False))
 
   def get_child_file(
           self,
           relative_file_path,
           force_children_retrieval=False) -> Optional["MsFileInfo"]:
     path_parts = relative_file_path.split(os.sep)
+    indexed_file = self.__get_indexed_child(path_parts, MsFileInfo)
+    if indexed_file is not None:
+      return indexed_file
     search_folder = self
     i = 0
     while i < (len(path_parts) - 1):
@@ -436,7 +947,7 @@ class MsFolderInfo(MsObject):
           force_children_retrieval=False):
     if force_children_retrieval and not self.folders_retrieval_has_started():
       self.retrieve_children_info(only_folders=True)
-    return folder_name in self.__dict_children_folder
+    return folder_name in (".", "..") or folder_name in self.__children_folder
 
   def relative_path_is_a_folder(
           self,
@@ -449,7 +960,7 @@ class MsFolderInfo(MsObject):
   def is_direct_child_file(self, file_name, force_children_retrieval=False):
     if force_children_retrieval and not self.folders_retrieval_has_started():
       self.retrieve_children_info(only_folders=False)
-    return file_name in self.__dict_children_file
+    return file_name in self.__children_file
 
   def relative_path_is_a_file(
           self,
@@ -482,6 +993,14 @@ class MsFolderInfo(MsObject):
   def folders_retrieval_is_completed(self):
     return self.__children_folders_retrieval_status == "all"
 
+  def children_age(self):
+    """ Seconds elapsed since the last complete listing of the children.
+        None if the children have never been completely listed.
+    """
+    if self.children_retrieval_time is None:
+      return None
+    return time.monotonic() - self.children_retrieval_time
+
   def __str__(self):
     status_subfolders = "<subfolders ok>" if self.folders_retrieval_has_started() else ""
     status_subfiles = "<subfiles ok>" if self.files_retrieval_has_started() else ""
@@ -509,14 +1028,32 @@ class MsFolderInfo(MsObject):
 
 
 class MsFileInfo(MsObject):
+  __slots__ = ("mgc", "sha1hash", "qxh", "__fs_lmdt")
+
   def __init__(
           self, name, parent_path, mgc, file_id,
-          size, qxh, s1h, cdt, lmdt, parent=None):
+          size, qxh, s1h, cdt, lmdt, parent=None, fs_lmdt=None):
     # qxh = quickxorhash
+    # fs_lmdt = last modification datetime of file system (client side)
     super().__init__(parent, name, parent_path, file_id, size, lmdt, cdt)
     self.mgc = mgc
     self.sha1hash = s1h
     self.qxh = qxh
+    self.__fs_lmdt = fs_lmdt
+
+  @property
+  def fs_last_modified_datetime(self):
+    if isinstance(self.__fs_lmdt, str):
+      self.__fs_lmdt = utc_dt_from_str_ms_datetime(self.__fs_lmdt)
+    return self.__fs_lmdt
+
+  @fs_last_modified_datetime.setter
+  def fs_last_modified_datetime(self, fs_lmdt):
+    self.__fs_lmdt = fs_lmdt
+
+  def _copy_datetimes(self, reference: "MsFileInfo"):
+    super()._copy_datetimes(reference)
+    self.__fs_lmdt = reference.__fs_lmdt
 
   def _get_id(self):
     return self.__id
@@ -524,9 +1061,7 @@ class MsFileInfo(MsObject):
 
   def _change_name_in_parent(self, new_name):
     if self.parent is not None:
-      if self.name in self.parent._MsFolderInfo__dict_children_file:
-        self.parent._MsFolderInfo__dict_children_file.pop(self.name)
-        self.parent._MsFolderInfo__dict_children_file[new_name] = self
+      self.parent._rename_child(self, new_name)
 
   def __str__(self):
     fname = f"{self.name}" if len(self.name) < 45 else f"{self.name[:40]}..."
@@ -544,7 +1079,8 @@ class MsFileInfo(MsObject):
         f"  quickXorHash          = {self.qxh}\n"
         f"  sha1Hash              = {self.sha1hash}\n"
         f"  creationDateTime      = {self.creation_datetime}\n"
-        f"  lastModifiedDateTime  = {self.last_modified_datetime}"
+        f"  lastModifiedDateTime  = {self.last_modified_datetime}\n"
+        f"  fsLastModifiedDateTime= {self.fs_last_modified_datetime}"
     )
 
     return result
@@ -555,35 +1091,121 @@ class MsFileInfo(MsObject):
 
 class DictMsObject():
   __dict_already_discovered_object = {}
-  __lock_dict = Lock()  # only used for removing object from dict which is unsafe (1)
+  # Lock of the dicts of the class. No lock of a folder is taken while it is
+  # held. Reading one entry does not need it (1)
   # (1) https://superfastpython.com/thread-safe-dictionary-in-python/
+  __lock_dict = Lock()
+
+  # id of a listed child whose info is not built -> (parent, name, is_folder)
+  __dict_raw_children = {}
+
+  # Children of folders are forgotten, least recently used first, when
+  # more than __max_objects objects are known. None for no limit
+  __max_objects = None
+  __lru_folders = OrderedDict()  # folder -> None
+
+  @staticmethod
+  def set_max_objects(max_objects: Optional[int]):
+    DictMsObject.__max_objects = max_objects
+
+  @staticmethod
+  def nb_objects():
+    with DictMsObject.__lock_dict:
+      return (len(DictMsObject.__dict_already_discovered_object)
+              + len(DictMsObject.__dict_raw_children))
+
+  @staticmethod
+  def touch(folder):
+    """ Record a use of the children of folder """
+    if DictMsObject.__max_objects is None:
+      return
+    with DictMsObject.__lock_dict:
+      DictMsObject.__lru_folders[folder] = None
+      DictMsObject.__lru_folders.move_to_end(folder)
+
+  @staticmethod
+  def evict_if_necessary(current_folder=None):
+    """ Forget children of least recently used folders until the number of
+        known objects is below the limit. current_folder and its parents are
+        kept. Return the number of forgotten objects.
+    """
+    if (DictMsObject.__max_objects is None
+            or DictMsObject.nb_objects() <= DictMsObject.__max_objects):
+      return 0
+    kept_folders = []
+    folder = current_folder
+    while folder is not None:
+      kept_folders.append(folder)
+      folder = folder.parent
+    nb_objects = 0
+    while (DictMsObject.nb_objects() > DictMsObject.__max_objects
+           and len(DictMsObject.__lru_folders) > 0):
+      with DictMsObject.__lock_dict:
+        folder = DictMsObject.__lru_folders.popitem(last=False)[0]
+      if any(folder is f for f in kept_folders):
+        continue
+      nb_objects += folder.forget_children()
+    for folder in reversed(kept_folders):
+      DictMsObject.touch(folder)
+    lg.debug(f"[evict_if_necessary]{nb_objects} objects forgotten")
+    return nb_objects
 
   @staticmethod
   def get(ms_id) -> Optional[MsObject]:
+    """ Object of ms_id. Its info is built if it has only been listed """
     with DictMsObject.__lock_dict:
-      if ms_id in DictMsObject.__dict_already_discovered_object:
-        result = DictMsObject.__dict_already_discovered_object[ms_id]
-      else:
-        result = None
+      result = DictMsObject.__dict_already_discovered_object.get(ms_id)
+      raw_child = (
+          DictMsObject.__dict_raw_children.get(ms_id)
+          if result is None else None)
+    if raw_child is not None:
+      (parent, name, is_folder) = raw_child
+      result = parent._build_child(name, is_folder)
+      if result is not None and result.ms_id != ms_id:
+        result = None   # Child has been replaced meanwhile
     return result
 
+  @staticmethod
+  def get_built(ms_id) -> Optional[MsObject]:
+    """ Object of ms_id. None if its info is not built """
+    with DictMsObject.__lock_dict:
+      return DictMsObject.__dict_already_discovered_object.get(ms_id)
+
+  @staticmethod
+  def add_raw(ms_id, parent, name, is_folder):
+    with DictMsObject.__lock_dict:
+      DictMsObject.__dict_raw_children[ms_id] = (parent, name, is_folder)
+
+  @staticmethod
+  def discard_raw(ms_id, parent):
+    with DictMsObject.__lock_dict:
+      raw_child = DictMsObject.__dict_raw_children.get(ms_id)
+      if raw_child is not None and raw_child[0] is parent:
+        DictMsObject.__dict_raw_children.pop(ms_id)
+
   @staticmethod
   def remove(ms_id):
+    """ Remove object of ms_id. It may have been removed by another thread """
     with DictMsObject.__lock_dict:
-      DictMsObject.__dict_already_discovered_object.pop(ms_id)
+      obj = DictMsObject.__dict_already_discovered_object.pop(ms_id, None)
+      if obj is not None:
+        DictMsObject.__lru_folders.pop(obj, None)
 
   @staticmethod
   @beartype
-  def add_or_update(obj: MsObject):
-    if obj.ms_id in DictMsObject.__dict_already_discovered_object:
-      obj_dict = DictMsObject.__dict_already_discovered_object[obj.ms_id]
-      if isinstance(obj, MsFolderInfo):
-        ObjectInfoFactory.UpdateMsFolderInfo(obj_dict, obj)
-      else:
-        ObjectInfoFactory.UpdateMsFileInfo(obj_dict, obj)
+  def register(obj: MsObject) -> MsObject:
+    """ Add obj if its id is unknown. Return the object known with this id """
+    with DictMsObject.__lock_dict:
+      return DictMsObject.__dict_already_discovered_object.setdefault(
+          obj.ms_id, obj)
 
-    else:
-      DictMsObject.__dict_already_discovered_object[obj.ms_id] = obj
+  @staticmethod
+  @beartype
+  def add_or_update(obj: MsObject):
+    obj_dict = DictMsObject.register(obj)
+    # Update is done out of the lock: it may lock folders
+    if obj_dict is not obj:
+      ObjectInfoFactory.update_object_info(obj_dict, obj)
 
 
 class ObjectInfoFactory:
@@ -604,8 +1226,12 @@ class ObjectInfoFactory:
       path = path[1:]
     # Consider root
     prefixed_path = "" if path == "/" or path == "" else f":/{path}"
-    r = mgc.mgc.get(
-        f'{MsGraphClient.graph_url}/me/drive/root{prefixed_path}').json()
+    r = None
+    if mgc.drive_index is not None:
+      r = mgc.drive_index.get_item(path)
+    if r is None:
+      r = mgc.mgc.get(
+          f'{MsGraphClient.graph_url}/me/drive/root{prefixed_path}').json()
     if 'error' in r:
       return (r['error']['code'], None)
 
@@ -681,10 +1307,8 @@ class ObjectInfoFactory:
         child_count=mgc_response_json['folder']['childCount'],
         size=mgc_response_json['size'],
         parent=parent,
-        lmdt=utc_dt_from_str_ms_datetime(
-            mgc_response_json['lastModifiedDateTime']),
-        cdt=utc_dt_from_str_ms_datetime(
-            mgc_response_json['createdDateTime']),
+        lmdt=mgc_response_json['lastModifiedDateTime'],
+        cdt=mgc_response_json['createdDateTime'],
         is_root=is_root)
     if parent is not None:
       parent._MsFolderInfo__add_folder_info_if_necessary(result)
@@ -693,6 +1317,13 @@ class ObjectInfoFactory:
       DictMsObject.add_or_update(result)
     return result
 
+  @staticmethod
+  def update_object_info(obj_to_be_updated, obj_reference):
+    if isinstance(obj_reference, MsFolderInfo):
+      ObjectInfoFactory.UpdateMsFolderInfo(obj_to_be_updated, obj_reference)
+    else:
+      ObjectInfoFactory.UpdateMsFileInfo(obj_to_be_updated, obj_reference)
+
   @staticmethod
   @beartype
   def UpdateMsFolderInfo(
@@ -702,8 +1333,7 @@ class ObjectInfoFactory:
     fi_to_be_updated.set_name(fi_reference.name)
     fi_to_be_updated.set_size(fi_reference.size)
 
-    fi_to_be_updated.last_modified_datetime = fi_reference.last_modified_datetime
-    fi_to_be_updated.creation_datetime = fi_reference.creation_datetime
+    fi_to_be_updated._copy_datetimes(fi_reference)
     if update_child_count:
       fi_to_be_updated.child_count = fi_reference.child_count
 
@@ -715,8 +1345,7 @@ class ObjectInfoFactory:
     fi_to_be_updated.set_name(fi_reference.name)
     fi_to_be_updated.set_size(fi_reference.size)
 
-    fi_to_be_updated.last_modified_datetime = fi_reference.last_modified_datetime
-    fi_to_be_updated.creation_datetime = fi_reference.creation_datetime
+    fi_to_be_updated._copy_datetimes(fi_reference)
     fi_to_be_updated.qxh = fi_reference.qxh
     fi_to_be_updated.sha1hash = fi_reference.sha1hash
 
@@ -738,6 +1367,11 @@ class ObjectInfoFactory:
              if 'quickXorHash' in mgc_hashes else None)
       sha1hash = (mgc_hashes['sha1Hash']
                   if 'sha1Hash' in mgc_hashes else None)
+    if ('fileSystemInfo' in mgc_response_json
+            and 'lastModifiedDateTime' in mgc_response_json['fileSystemInfo']):
+      fs_lmdt = mgc_response_json['fileSystemInfo']['lastModifiedDateTime']
+    else:
+      fs_lmdt = None
     ms_id = mgc_response_json['id']
     result = MsFileInfo(
         mgc_response_json['name'],
@@ -745,11 +1379,10 @@ class ObjectInfoFactory:
         mgc,
         ms_id, mgc_response_json['size'],
         qxh, sha1hash,
-        utc_dt_from_str_ms_datetime(
-            mgc_response_json['createdDateTime']),
-        utc_dt_from_str_ms_datetime(
-            mgc_response_json['lastModifiedDateTime']),
-        parent=parent)
+        mgc_response_json['createdDateTime'],
+        mgc_response_json['lastModifiedDateTime'],
+        parent=parent,
+        fs_lmdt=fs_lmdt)
 
     if parent is not None:
       parent._MsFolderInfo__add_file_info_if_necessary(result)
@@ -2,6 +2,7 @@
 #  This file is part of OneDrive Client Program which is released under MIT License
 #  See file LICENSE for full license details
 import argparse
+import json
 import logging
 import os
 import re
@@ -11,6 +12,7 @@ import sys
 import time
 import traceback
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from pprint import pprint
 from threading import Event, Thread, Lock
@@ -21,6 +23,7 @@ from colorama import init as cinit
 
 from lib._common import PROGRAM_NAME, get_versionned_name
 from lib._typing import List, Optional, Tuple
+from lib.file_config_helper import force_permission_file_read_write_owner
 from lib.graph_helper import MsGraphClient
 from lib.msobject_info import DictMsObject, MsFileInfo, MsFolderInfo, MsObject
 from lib.msobject_info import ObjectInfoFactory as Oif
@@ -195,14 +198,9 @@ class SubCompleterFileOrFolder(SubCompleter):
     #   3. Keep folders whose name starts with start_text
     #   4. Add escaped folder name
     search_folder.retrieve_children_info(only_folders=self.__only_folder)
-    if self.__only_folder:
-      all_children = search_folder.children_folder
-    else:
-      all_children = search_folder.children_folder + search_folder.children_file
     folders = map(
-        lambda x: f"{x.name}{'/' if isinstance(x, MsFolderInfo) else ''}",
-        all_children)
-    folders = filter(lambda x: x.startswith(start_text), folders)
+        lambda x: f"{x[0]}{'/' if x[1] else ''}",
+        search_folder.children_names(start_text, self.__only_folder))
     folders = map(lambda x: StrPathUtil.escape_str(x), folders)
     map_values = map(
         lambda x: SubCompleter.SCResult(
@@ -412,18 +410,19 @@ class Completer:
     try:
 
       if state == 0:
-        with self.shell.global_lock:
-          parts_cmd = CommonCompleter.get_cmd_parts_with_quotation_guess(text)
-          if len(parts_cmd) > 0 and (parts_cmd[0] in self.shell.dict_cmds):
-            sub_completer = self.shell.dict_cmds[parts_cmd[0]].sub_completer
-            self.values = sub_completer.values(text)
+        # Completion only reads folder infos: it does not wait for the end
+        # of delta processing
+        parts_cmd = CommonCompleter.get_cmd_parts_with_quotation_guess(text)
+        if len(parts_cmd) > 0 and (parts_cmd[0] in self.shell.dict_cmds):
+          sub_completer = self.shell.dict_cmds[parts_cmd[0]].sub_completer
+          self.values = sub_completer.values(text)
 
-          elif len(parts_cmd) > 0 and parts_cmd[0][0] == "!":
-            sub_completer = SubCompleterLocalCommand()
-            self.values = sub_completer.values(text)
+        elif len(parts_cmd) > 0 and parts_cmd[0][0] == "!":
+          sub_completer = SubCompleterLocalCommand()
+          self.values = sub_completer.values(text)
 
-          else:
-            self.values = []
+        else:
+          self.values = []
 
       if state < len(self.values):
         self.__log_debug(f"  --> return {self.values[state]}")
@@ -461,6 +460,9 @@ class DeltaChecker():
       else:
         break
     self.delta_link = r.json()['@odata.deltaLink']
+    if len(self.items_to_be_process) > 0 and self.mgc.drive_index is not None:
+      # Drive has been changed elsewhere: index is refreshed before next use
+      self.mgc.drive_index.dirty = True
 
   def __process_diff_delete(self, diff_item):
     """
@@ -646,7 +648,7 @@ class ServerCheckDelta():
     self.is_stopped = Event()
     self.mgc = mgc
     self.lg = logging.getLogger("odc.browser.checkdelta")
-    self.dc = DeltaChecker(mgc)
+    self.dc = None  # Created by bootstrap() which sends a request
 
     self.__ema = self.__class__.EMA()
     self.__min_wait_delay = 15  # seconds
@@ -656,23 +658,35 @@ class ServerCheckDelta():
 
     self.__lock_process = lock_process
 
+  def bootstrap(self):
+    """ Get the delta link from which changes will be checked """
+    try:
+      self.dc = DeltaChecker(self.mgc)
+    except Exception as e:
+      self.lg.error(f"Error during initialization of delta checking: {e}")
+
   def loop(self):
     while True:
       self.lg.debug(f"start delta processing - {self.counter}")
-      try:
-        with self.__lock_process:
+      if self.dc is None:
+        self.bootstrap()
+      # If bootstrap has failed, it is tried again at next loop
+      if self.dc is not None:
+        try:
+          # Requests are sent without blocking commands
           self.dc.get_diffs()
           # self.dc.print_last_diffs()
           if len(self.dc.items_to_be_process) > 0:
-            self.dc.process_diffs()
-      except Exception as e:
-        self.lg.error(f"Error during processing diff: {e}")
-        if self.lg.level >= logging.DEBUG:
-          error_line = "stack trace :\n"
-          for a in traceback.format_tb(e.__traceback__):  # Print traceback
-            error_line += f"  {a}"
-          self.lg.debug(error_line)
-      self.dc.reinit()
+            with self.__lock_process:
+              self.dc.process_diffs()
+        except Exception as e:
+          self.lg.error(f"Error during processing diff: {e}")
+          if self.lg.level >= logging.DEBUG:
+            error_line = "stack trace :\n"
+            for a in traceback.format_tb(e.__traceback__):  # Print traceback
+              error_line += f"  {a}"
+            self.lg.debug(error_line)
+        self.dc.reinit()
       self.lg.debug(f"end delta processing - {self.counter}"
                     f" - wait {self.__wait_delay:.1f} seconds")
 
@@ -705,6 +719,56 @@ class ServerCheckDelta():
     self.is_stopped.wait(timeout=5)
 
 
+class ListingRefresher():
+  """ Refresh in background the children of folders whose listing is older
+      than ttl seconds. Stale children are displayed meanwhile.
+  """
+
+  def __init__(self, mgc: MsGraphClient, ttl=60):
+    self.mgc = mgc
+    self.ttl = ttl
+    self.lg = logging.getLogger("odc.browser.refresher")
+    self.__executor = ThreadPoolExecutor(max_workers=2)
+    self.__pending = set()  # ids of folders being refreshed
+    self.__lock_pending = Lock()
+
+  def refresh_if_stale(self, fi: MsFolderInfo, only_folders: bool):
+    """ Launch a refresh of the children of fi if they are stale. Return True
+        if a refresh is launched or running.
+    """
+    age = fi.children_age()
+    if age is None or age < self.ttl:
+      return False
+    with self.__lock_pending:
+      if fi.ms_id in self.__pending:
+        return True
+      self.__pending.add(fi.ms_id)
+    self.lg.debug(f"{fi.path} - listing is {age:.0f} seconds old - refresh")
+    self.__executor.submit(self.__refresh, fi, fi.path, only_folders)
+    return True
+
+  def __refresh(self, fi, path, only_folders):
+    try:
+      # Request is sent without blocking commands
+      # Drive index may be out of date: children are listed on server
+      ms_response = self.mgc.get_all_children_of_folder_path(
+          path, only_folders, use_index=False)
+      if ms_response is None:
+        self.lg.warning(f"{path} - listing can not be refreshed")
+        return
+      if fi.path != path or DictMsObject.get(fi.ms_id) is not fi:
+        return  # Folder has been moved or removed meanwhile
+      fi.update_children_from_ms_response(ms_response, only_folders)
+    except Exception as e:
+      self.lg.error(f"Error during refresh of {path}: {e}")
+    finally:
+      with self.__lock_pending:
+        self.__pending.discard(fi.ms_id)
+
+  def stop(self):
+    self.__executor.shutdown(wait=False)
+
+
 class OneDriveShell:
 
   class ArgumentParserWithoutExit(argparse.ArgumentParser):
@@ -746,20 +810,34 @@ class OneDriveShell:
       self._do_action(args)
 
   @beartype
-  def __init__(self, mgc: MsGraphClient):
+  def __init__(
+          self,
+          mgc: MsGraphClient,
+          root_cache_filename: Optional[str] = None):
+    """ root_cache_filename is the file where the listing of root folder is
+        stored. If it exists, the shell starts from it while the listing is
+        revalidated in background.
+    """
     cinit()  # initialize colorama
     self.mgc = mgc
-    self.root_folder = Oif.get_object_info(
-        mgc, "/", no_warn_if_no_parent=True)[1]
+    self.root_cache_filename = root_cache_filename
+    self.root_folder = self.__load_root_cache()
+    self.root_is_from_cache = self.root_folder is not None
+    if self.root_folder is None:
+      self.root_folder = Oif.get_object_info(
+          mgc, "/", no_warn_if_no_parent=True)[1]
     self.current_fi = self.root_folder
     self.only_folders = False
     self.ls_formatter = LsFormatter(MsFileFormatter(20), MsFolderFormatter(20))
     self.cp = Completer(self)
     self.initiate_commands()
-    # Lock to ensure no simultaneousity of command launch, completion and
-    # delta checking
+    # Lock to ensure no simultaneousity of commands and processing of
+    # changes of the drive. Each one makes several changes which depend on
+    # each other. Folder infos are thread-safe: completion and refresh of
+    # listings do not need it
     self.global_lock = Lock()
     self.scd = ServerCheckDelta(self.mgc, self.global_lock)
+    self.refresher = ListingRefresher(self.mgc)
 
   def initiate_commands(self):
 
@@ -800,20 +878,38 @@ class OneDriveShell:
       # Print errors
       list(map(lambda x: print(x), errors))
 
+      # Stale listings are printed with their age and refreshed in
+      # background
+      stale_ages = {}   # id of folder -> age of its listing
+      for fi in paths_to_be_listed:
+        age = fi.children_age()
+        if self.refresher.refresh_if_stale(fi, self.only_folders):
+          stale_ages[fi.ms_id] = age
+
       # Print paths
       lines_to_be_printed = []
       for fi in paths_to_be_listed:
         if len(paths_to_be_listed) > 1:
           lines_to_be_printed.append("")
-          lines_to_be_printed.append(f"{fi.path}/:")
+        # Header of the folder is printed once: here or by the formatter
+        with_header = True
+        if len(paths_to_be_listed) > 1 or fi.ms_id in stale_ages:
+          header = f"{fi.path}/:"
+          if fi.ms_id in stale_ages:
+            header += (
+                f" (listed {stale_ages[fi.ms_id]:.0f} seconds ago"
+                " - refreshing)")
+          lines_to_be_printed.append(header)
+          with_header = False
         str_folder_children = (
             self.ls_formatter.format_folder_children_lite(
                 fi,
                 only_folders=self.only_folders,
                 recursive=args.r,
-                depth=args.d) if not args.l else self.ls_formatter.format_folder_children_long(
+                depth=args.d,
+                with_header=with_header) if not args.l else self.ls_formatter.format_folder_children_long(
                 fi, only_folders=self.only_folders,
-                recursive=args.r, depth=args.d))
+                recursive=args.r, depth=args.d, with_header=with_header))
 
         lines_to_be_printed.append(str_folder_children)
       str_to_be_printed = '\n'.join(lines_to_be_printed)
@@ -1089,8 +1185,63 @@ class OneDriveShell:
     result += "> "
     return result
 
+  def __load_root_cache(self):
+    if self.root_cache_filename is None:
+      return None
+    try:
+      with open(self.root_cache_filename, 'r') as f:
+        root_cache = json.load(f)
+      root_folder = Oif.MsFolderFromMgcResponse(
+          self.mgc, root_cache["root"], no_warn_if_no_parent=True)
+      root_folder.update_children_from_ms_response(root_cache["children"])
+      return root_folder
+    except FileNotFoundError:
+      return None
+    except Exception as e:
+      lg.warning(f"Cached root folder can not be read: {e}")
+      return None
+
+  def __store_root_cache(self, root_json, children_json):
+    if self.root_cache_filename is None:
+      return
+    tmp_filename = f"{self.root_cache_filename}.tmp"
+    with open(tmp_filename, 'w') as f:
+      json.dump({"root": root_json, "children": children_json}, f)
+    force_permission_file_read_write_owner(tmp_filename)
+    os.replace(tmp_filename, self.root_cache_filename)
+
+  def revalidate_root(self):
+    """ Update root folder and its children with their current state on
+        server, and store them for next launch.
+    """
+    try:
+      # Requests are sent without blocking commands
+      root_json = self.mgc.mgc.get(
+          f"{MsGraphClient.graph_url}/me/drive/root").json()
+      # Drive index may be out of date: children are listed on server
+      children_json = self.mgc.get_all_children_of_folder_path(
+          "", use_index=False)
+      if 'error' in root_json or children_json is None:
+        lg.warning("Root folder can not be revalidated")
+        return
+      Oif.UpdateMsFolderInfo(
+          self.root_folder,
+          Oif.MsFolderFromMgcResponse(
+              self.mgc, root_json, no_warn_if_no_parent=True,
+              no_update_of_global_dict=True))
+      self.root_folder.update_children_from_ms_response(children_json)
+      self.__store_root_cache(root_json, children_json)
+    except Exception as e:
+      lg.error(f"Error during revalidation of root folder: {e}")
+
+  def __background_start(self):
+    # Delta link is taken before revalidation so that no change is missed
+    self.scd.bootstrap()
+    self.revalidate_root()
+    self.scd.loop()
+
   def launch_delta_server(self):
-    thread_scd = Thread(target=self.scd.loop, daemon=True)
+    thread_scd = Thread(target=self.__background_start, daemon=True)
     thread_scd.start()
 
   def stop_delta_server(self):
@@ -1105,8 +1256,9 @@ class OneDriveShell:
     # All line content will be managed by complemtion
     readline.set_completer_delims("")
 
-    self.current_fi.retrieve_children_info(
-        only_folders=self.only_folders, recursive=False)
+    if not self.root_is_from_cache:
+      self.current_fi.retrieve_children_info(
+          only_folders=self.only_folders, recursive=False)
 
     print(get_versionned_name())
     print('Type "help" or "license" for more information')
@@ -1134,6 +1286,7 @@ class OneDriveShell:
           args = self.__args_parser.parse_args(parts_cmd)
           with self.global_lock:
             self.dict_cmds[cmd].do_action(args)
+            DictMsObject.evict_if_necessary(self.current_fi)
           self.scd.tick()
         except Exception as e:
           print(f"error: {e}")
@@ -1213,6 +1366,7 @@ class OneDriveShell:
         print("unknown command")
 
     self.stop_delta_server()
+    self.refresher.stop()
 
   def full_path_from_root_folder(self, str_path):
     """
@@ -1326,13 +1480,24 @@ class LsFormatter():
           only_folders: bool = True,
           recursive: bool = False,
           depth: int = 999,
-          is_first_folder: bool = False) -> str:
+          is_first_folder: bool = False,
+          with_header: bool = True) -> str:
     # A header with the folder path is added to each children
-    # The same header is added if is_first_folder is True
+    # The same header is added if is_first_folder and with_header are True
 
     lg.debug(
         f"Entering __format_folder_children_lite({fi.path},"
         f"{only_folders}, {recursive}, {depth})")
+    if recursive and depth > 0 and is_first_folder:
+      # Retrieve the tree at once: with delta if it is deep and unknown, by
+      # listing several folders at the same time otherwise. Folders already
+      # listed are not listed again
+      fi.retrieve_children_info(
+          only_folders=only_folders, recursive=True, depth=depth + 1,
+          use_delta=(not fi.folders_retrieval_has_started()
+                     or any(not cf.folders_retrieval_has_started()
+                            for cf in fi.children_folder)),
+          nb_workers=MsFolderInfo.NB_CONCURRENT_LISTINGS)
     if ((not fi.folders_retrieval_has_started() and only_folders)
             or (not fi.files_retrieval_has_started() and not only_folders)):
       fi.retrieve_children_info(only_folders=only_folders)
@@ -1350,7 +1515,7 @@ class LsFormatter():
       result = '\n'.join(list(map(lambda x: x.to_be_printed, all_names)))
 
     if recursive and depth > 0 and len(fi.children_folder) > 0:
-      if is_first_folder:
+      if is_first_folder and with_header:
         result = f"{fi.path}/:\n" + result
 
       result += "\n"
@@ -1377,12 +1542,13 @@ class LsFormatter():
           fi: MsFolderInfo,
           recursive: bool = False,
           only_folders: bool = True,
-          depth: int = 999) -> str:
+          depth: int = 999,
+          with_header: bool = True) -> str:
     return self.__format_folder_children(
         fi, False,
         self.folder_formatter.format, self.file_formatter.format,
         only_folders, recursive,
-        depth, True
+        depth, True, with_header
     )
 
   @beartype
@@ -1404,7 +1570,8 @@ class LsFormatter():
           fi: MsFolderInfo,
           only_folders: bool = True,
           recursive: bool = False,
-          depth: int = 999) -> str:
+          depth: int = 999,
+          with_header: bool = True) -> str:
     lg.debug(
         f"Entering format_folder_children_lite({fi.path},"
         f"{only_folders}, {recursive}, {depth})")
@@ -1412,7 +1579,8 @@ class LsFormatter():
     result = self.__format_folder_children(
         fi, True,
         self.folder_formatter.format_lite, self.file_formatter.format_lite,
-        only_folders, recursive, depth, is_first_folder=True)
+        only_folders, recursive, depth, is_first_folder=True,
+        with_header=with_header)
 
     return result
 
@@ -8,6 +8,9 @@
 import logging
 from lib.auth_helper import TokenRecorder
 from lib.graph_helper import MsGraphClient
+from lib.journal_helper import UploadJournal
+from lib.cache_helper import HashCache
+from lib.index_helper import DriveIndex
 
 from lib.args_helper import parse_odc_args
 from lib.action_helper import (
@@ -18,7 +21,7 @@ from lib.action_helper import (
     action_download, action_mdownload,
     action_get_info, action_share,
     action_shell, action_qxh, action_move, action_remove,
-    action_mkdir
+    action_mkdir, action_index
 )
 from lib.file_config_helper import create_and_get_config_folder, force_permission_file_read_write_owner
 import os
@@ -102,7 +105,18 @@ if __name__ == '__main__':
     quit()
 
   # Manage command
-  mgc = MsGraphClient(tr.get_session_from_token())
+  upload_journal = UploadJournal(f"{config_dirname}/.upload_journal.json")
+  mgc = MsGraphClient(tr.get_session_from_token(), upload_journal)
+
+  # Drive index is used once it has been built by index command
+  drive_index_file_name = f"{config_dirname}/.drive_index.db"
+  if args.command == "index" or os.path.exists(drive_index_file_name):
+    mgc.drive_index = DriveIndex(drive_index_file_name, mgc)
+    force_permission_file_read_write_owner(drive_index_file_name)
+
+  if args.command == "index":
+    action_index(mgc.drive_index, args.reset)
+
   if args.command == "whoami":
     action_get_user(mgc)
 
@@ -112,22 +126,34 @@ if __name__ == '__main__':
     action_get_children(mgc, args.folder, args.p)
 
   if args.command == "put":
-    action_upload(mgc, args.dstpath, args.srcfile, args.withprogressbar)
+    action_upload(
+        mgc, args.dstpath, args.srcfile, args.withprogressbar, args.reader,
+        None if args.chunk_size is None else args.chunk_size * 1048576)
 
   if args.command == "mput":
-    action_mupload(mgc, args.srclocalpath, args.dstremotefolder)
+    hash_cache = HashCache(f"{config_dirname}/.hash_cache.db")
+    action_mupload(
+        mgc, args.srclocalpath, args.dstremotefolder, args.jobs, hash_cache,
+        args.compare)
+    hash_cache.close()
 
   if args.command == "raw_cmd":
     action_raw_cmd(mgc)
 
   if args.command == "shell":
-    action_shell(mgc)
+    action_shell(
+        mgc, f"{config_dirname}/.shell_root.json", args.max_objects)
 
   if args.command == "get":
-    action_download(mgc, args.remotefile, args.dstlocalpath)
+    action_download(
+        mgc, args.remotefile, args.dstlocalpath, args.connections)
 
   if args.command == "mget":
-    action_mdownload(mgc, args.remotefolder, args.dstlocalpath, args.depth)
+    hash_cache = HashCache(f"{config_dirname}/.hash_cache.db")
+    action_mdownload(
+        mgc, args.remotefolder, args.dstlocalpath, args.depth, args.jobs,
+        hash_cache, args.compare)
+    hash_cache.close()
 
   if args.command == "mv":
     action_move(mgc, args.srcpath, args.dstpath)
@@ -145,9 +171,11 @@ if __name__ == '__main__':
     action_mkdir(mgc, args.remotefolder)
 
   if args.command == "qxh":
-    action_qxh(args.srcfile)
+    action_qxh(args.srcfile, args.backend, args.benchmark)
 
   if args.command == "version":
     print(VERSION)
 
+  if mgc.drive_index is not None:
+    mgc.drive_index.close()
   mgc.close()